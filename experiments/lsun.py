@@ -17,7 +17,7 @@ from torch.utils.data.dataloader import DataLoader
 from torchvision.utils import save_image
 from torch.nn.utils import clip_grad_norm_
 
-from macow.data import load_datasets, get_batch, preprocess, postprocess
+from macow.data import load_datasets, get_batch, preprocess, postprocess, CUDAPrefetcher
 from macow.models import FlowGenModel, VDeQuantFlowGenModel
 from macow.utils import exponentialMovingAverage, total_grad_norm
 
@@ -83,6 +83,8 @@ np.random.shuffle(train_index)
 test_index = np.arange(len(test_data))
 
 train_loader = DataLoader(train_data, batch_size=args.batch_size, shuffle=True, num_workers=args.workers, pin_memory=True)
+if args.cuda:
+    train_loader = CUDAPrefetcher(train_loader)
 test_loader = DataLoader(test_data, batch_size=100, shuffle=False, num_workers=args.workers, pin_memory=True)
 batch_steps = args.batch_steps
 
@@ -115,20 +117,22 @@ def train(epoch, k):
         nll_batch = 0
         nent_batch = 0
         data_list = [data, ] if batch_steps == 1 else data.chunk(batch_steps, dim=0)
-        for data in data_list:
-            x = preprocess(data, n_bits)
-            # [batch, k]
-            noise, log_probs_posterior = fgen.dequantize(x, nsamples=k)
-            # [batch, k] -> [1]
-            log_probs_posterior = log_probs_posterior.mean(dim=1).sum()
-            # [batch, k, channels, H, W] -> [batch, channels, H, W]
-            data = preprocess(data, n_bits, noise[:, 0:1]).squeeze(1)
-            log_probs = fgen.log_probability(data).sum()
-            loss = (log_probs_posterior - log_probs) / batch_size
-            loss.backward()
-            with torch.no_grad():
-                nll_batch -= log_probs.item()
-                nent_batch += log_probs_posterior.item()
+        for step, data in enumerate(data_list):
+            # skip the gradient all-reduce (DDP) for all but the last micro-batch
+            with fgen.no_sync(step < len(data_list) - 1):
+                x = preprocess(data, n_bits)
+                # [batch, k]
+                noise, log_probs_posterior = fgen.dequantize(x, nsamples=k)
+                # [batch, k] -> [1]
+                log_probs_posterior = log_probs_posterior.mean(dim=1).sum()
+                # [batch, k, channels, H, W] -> [batch, channels, H, W]
+                data = preprocess(data, n_bits, noise[:, 0:1]).squeeze(1)
+                log_probs = fgen.log_probability(data).sum()
+                loss = (log_probs_posterior - log_probs) / batch_size
+                loss.backward()
+                with torch.no_grad():
+                    nll_batch -= log_probs.item()
+                    nent_batch += log_probs_posterior.item()
 
         if grad_clip > 0:
             grad_norm = clip_grad_norm_(fgen.parameters(), grad_clip)
@@ -1,4 +1,5 @@
 __author__ = 'max'
 
 from macow.data.image import load_datasets, iterate_minibatches, get_batch, binarize_data, binarize_image
+from macow.data.image import binarize_dataset_mmap, BinarizedDataset, CUDAPrefetcher
 from macow.data.image import preprocess, postprocess
@@ -1,9 +1,13 @@
 import os
+import hashlib
+from typing import Optional
 import scipy.io
 import numpy as np
 
 import torch
+from torch.utils.data import DataLoader, Dataset, Subset, TensorDataset
 from torchvision import datasets, transforms
+from torchvision.transforms import v2
 
 
 def load_datasets(dataset, data_path=None):
@@ -28,69 +32,83 @@ def load_datasets(dataset, data_path=None):
         raise ValueError('unknown data set %s' % dataset)
 
 
-def load_omniglot():
+def convert_omniglot(mat_path='data/omniglot/chardata.mat', out_dir='data/omniglot'):
+    """
+    One-time conversion of the omniglot .mat file into .npy arrays that can be memory-mapped.
+    Conversion is skipped if the arrays already exist.
+    """
+    names = ['train_data', 'train_label', 'test_data', 'test_label']
+    paths = [os.path.join(out_dir, 'chardata_%s.npy' % name) for name in names]
+    if all(os.path.exists(path) for path in paths):
+        return paths
+
     def reshape_data(data):
-        return data.T.reshape((-1, 1, 28, 28))
+        return np.ascontiguousarray(data.T.reshape((-1, 1, 28, 28)), dtype=np.float32)
 
-    omni_raw = scipy.io.loadmat('data/omniglot/chardata.mat')
+    omni_raw = scipy.io.loadmat(mat_path)
+    arrays = [reshape_data(omni_raw['data']), omni_raw['target'].argmax(axis=0),
+              reshape_data(omni_raw['testdata']), omni_raw['testtarget'].argmax(axis=0)]
+    for path, array in zip(paths, arrays):
+        np.save(path, array)
+    return paths
 
-    train_data = reshape_data(omni_raw['data']).astype(np.float32)
-    train_label = omni_raw['target'].argmax(axis=0)
-    test_data = reshape_data(omni_raw['testdata']).astype(np.float32)
-    test_label = omni_raw['testtarget'].argmax(axis=0)
 
-    train_data = torch.from_numpy(train_data).float()
-    train_label = torch.from_numpy(train_label).long()
-    test_data = torch.from_numpy(test_data).float()
-    test_label = torch.from_numpy(test_label).long()
+def load_omniglot():
+    train_data, train_label, test_data, test_label = convert_omniglot()
+
+    # copy-on-write mapping: pages are read lazily from the OS page cache and torch gets a writable array
+    train_data = torch.from_numpy(np.load(train_data, mmap_mode='c'))
+    train_label = torch.from_numpy(np.load(train_label)).long()
+    test_data = torch.from_numpy(np.load(test_data, mmap_mode='c'))
+    test_label = torch.from_numpy(np.load(test_label)).long()
 
-    return [(train_data[i], train_label[i]) for i in range(len(train_data))], \
-           [(test_data[i], test_label[i]) for i in range(len(test_data))]
+    return TensorDataset(train_data, train_label), TensorDataset(test_data, test_label)
 
 
 def load_mnist():
     train_data, train_label = torch.load('data/mnist/processed/training.pt')
     test_data, test_label = torch.load('data/mnist/processed/test.pt')
 
-    train_data = train_data.float().div(256).unsqueeze(1)
-    test_data = test_data.float().div(256).unsqueeze(1)
+    train_data = train_data.to(torch.float32).div_(256).unsqueeze_(1)
+    test_data = test_data.to(torch.float32).div_(256).unsqueeze_(1)
 
-    return [(train_data[i], train_label[i]) for i in range(len(train_data))], \
-           [(test_data[i], test_label[i]) for i in range(len(test_data))]
+    return TensorDataset(train_data, train_label), TensorDataset(test_data, test_label)
 
 
 def load_lsun64(data_path, category):
+    # images stay uint8 (4x fewer bytes through pinned memory and H2D); preprocess() casts them on the device
     imageSize = 64
     train_data = datasets.LSUN(data_path, classes=[category + '_train'],
-                               transform=transforms.Compose([
-                                   transforms.Resize(96),
-                                   transforms.RandomCrop(imageSize),
-                                   transforms.ToTensor(),
+                               transform=v2.Compose([
+                                   v2.PILToTensor(),
+                                   v2.Resize(96, antialias=True),
+                                   v2.RandomCrop(imageSize),
                                ]))
 
     val_data = datasets.LSUN(data_path, classes=[category + '_val'],
-                             transform=transforms.Compose([
-                                 transforms.Resize(96),
-                                 transforms.RandomCrop(imageSize),
-                                 transforms.ToTensor(),
+                             transform=v2.Compose([
+                                 v2.PILToTensor(),
+                                 v2.Resize(96, antialias=True),
+                                 v2.RandomCrop(imageSize),
                              ]))
     return train_data, val_data
 
 
 def load_lsun128(data_path, category):
+    # images stay uint8, see load_lsun64
     imageSize = 128
     train_data = datasets.LSUN(data_path, classes=[category + '_train'],
-                               transform=transforms.Compose([
-                                   transforms.CenterCrop(256),
-                                   transforms.Resize(imageSize),
-                                   transforms.ToTensor(),
+                               transform=v2.Compose([
+                                   v2.PILToTensor(),
+                                   v2.CenterCrop(256),
+                                   v2.Resize(imageSize, antialias=True),
                                ]))
 
     val_data = datasets.LSUN(data_path, classes=[category + '_val'],
-                             transform=transforms.Compose([
-                                 transforms.CenterCrop(256),
-                                 transforms.Resize(imageSize),
-                                 transforms.ToTensor(),
+                             transform=v2.Compose([
+                                 v2.PILToTensor(),
+                                 v2.CenterCrop(256),
+                                 v2.Resize(imageSize, antialias=True),
                              ]))
     return train_data, val_data
 
@@ -139,36 +157,191 @@ def load_celeba(data_path, imageSize):
 
 
 def get_batch(data, indices):
-    imgs = []
-    labels = []
-    for index in indices:
-        img, label = data[index]
-        imgs.append(img)
-        labels.append(label)
-    return torch.stack(imgs, dim=0), torch.LongTensor(labels)
-
-
-def iterate_minibatches(data, indices, batch_size, shuffle):
-    if shuffle:
-        np.random.shuffle(indices)
-
-    for start_idx in range(0, len(indices), batch_size):
-        excerpt = indices[start_idx:start_idx + batch_size]
-        yield get_batch(data, excerpt)
+    if isinstance(data, TensorDataset):
+        # gather the whole batch from the in-memory tensors at once
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        imgs, labels = data.tensors
+        return imgs.index_select(0, indices), labels.index_select(0, indices)
+
+    # write samples straight into a (pinned) batch buffer instead of stacking a list
+    pin_memory = torch.cuda.is_available()
+    img, label = data[indices[0]]
+    imgs = torch.empty((len(indices), *img.size()), dtype=img.dtype, pin_memory=pin_memory)
+    labels = torch.empty(len(indices), dtype=torch.long, pin_memory=pin_memory)
+    imgs[0].copy_(img)
+    labels[0] = label
+    for i in range(1, len(indices)):
+        img, label = data[indices[i]]
+        imgs[i].copy_(img)
+        labels[i] = label
+    return imgs, labels
+
+
+def iterate_minibatches(data, indices, batch_size, shuffle, num_workers=None):
+    if isinstance(data, TensorDataset):
+        # in-memory data: a vectorized gather per batch beats worker processes
+        # shuffle a copy so that the caller's indices are left untouched
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        if shuffle:
+            indices = indices[torch.randperm(len(indices))]
+        return (get_batch(data, indices[start_idx:start_idx + batch_size])
+                for start_idx in range(0, len(indices), batch_size))
+
+    if num_workers is None:
+        num_workers = (os.cpu_count() or 2) // 2
+    # load and transform images in worker processes, overlapped with training
+    kwargs = {'prefetch_factor': 4} if num_workers > 0 else {}
+    return DataLoader(Subset(data, indices), batch_size=batch_size, shuffle=shuffle,
+                      num_workers=num_workers, pin_memory=torch.cuda.is_available(), **kwargs)
+
+
+class CUDAPrefetcher(object):
+    """
+    Wraps a data loader and copies the next batch to the GPU on a side stream
+    while the current batch is being processed.
+    The loader should use pinned memory so that the copies are asynchronous.
+    """
+    def __init__(self, loader, device=None):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+        self.iter = None
+        self.next_img = None
+        self.next_label = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iter = iter(self.loader)
+        self.preload()
+        while True:
+            batch = self.next()
+            if batch is None:
+                return
+            yield batch
+
+    def preload(self):
+        try:
+            img, label = next(self.iter)
+        except StopIteration:
+            self.next_img = None
+            self.next_label = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_img = img.cuda(self.device, non_blocking=True)
+            self.next_label = label.cuda(self.device, non_blocking=True)
+
+    def next(self):
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+        img, label = self.next_img, self.next_label
+        if img is None:
+            return None
+        # the tensors were allocated on the side stream but are consumed on the current one
+        img.record_stream(current_stream)
+        label.record_stream(current_stream)
+        self.preload()
+        return img, label
 
 
 def binarize_image(img):
-    return torch.rand(img.size()).type_as(img).le(img).float()
+    return torch.rand_like(img).le_(img).to(img.dtype)
 
 
 def binarize_data(data):
+    if isinstance(data, TensorDataset):
+        imgs, labels = data.tensors
+        return TensorDataset(binarize_image(imgs), labels)
     return [(binarize_image(img), label) for img, label in data]
 
 
-def preprocess(img, n_bits, noise=None):
+class BinarizedDataset(Dataset):
+    """
+    Dataset over several pre-sampled binarizations of the same images.
+    Each access returns one of the copies at random.
+    """
+    def __init__(self, cache, labels):
+        # [n_copies, N, channels, H, W] uint8 memmap
+        self.cache = cache
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        copy = torch.randint(self.cache.shape[0], ()).item()
+        img = torch.from_numpy(np.array(self.cache[copy, index])).float()
+        return img, self.labels[index]
+
+
+def _digest(tensor) -> str:
+    return hashlib.sha1(tensor.contiguous().numpy().tobytes()).hexdigest()
+
+
+def _dataset_labels(data):
+    # the labels without reading the images, if the data set keeps them apart (None otherwise)
+    if isinstance(data, TensorDataset):
+        return data.tensors[1]
+    targets = getattr(data, 'targets', None)
+    return None if targets is None else torch.as_tensor(targets)
+
+
+def binarize_dataset_mmap(data, path, n_copies=8, chunk_size=1024):
+    """
+    Sample ``n_copies`` binarizations of ``data`` once and keep them in a memory-mapped file,
+    so that stochastic binarization does not redo the Bernoulli sampling every epoch.
+    The labels and a fingerprint of the data set (its shape, n_copies, a hash of the labels and of
+    the first image) are stored next to it in ``path + '.meta'``; the cache is only reused if the
+    fingerprint matches, and then without reading the images again.
+    """
+    img, _ = data[0]
+    shape = (n_copies, len(data), *img.size())
+    meta_path = path + '.meta'
+    indices = np.arange(len(data))
+
+    labels = _dataset_labels(data)
+    if labels is None:
+        labels = torch.cat([get_batch(data, indices[start_idx:start_idx + chunk_size])[1]
+                            for start_idx in range(0, len(data), chunk_size)], dim=0)
+    labels = labels.long()
+    fingerprint = (shape, _digest(labels), _digest(img))
+
+    if os.path.exists(meta_path) and os.path.exists(path) and os.path.getsize(path) == int(np.prod(shape)):
+        meta = torch.load(meta_path, weights_only=True)
+        if meta['fingerprint'] == fingerprint:
+            cache = np.memmap(path, dtype=np.uint8, mode='r', shape=shape)
+            return BinarizedDataset(cache, meta['labels'])
+        os.remove(meta_path)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # memmap creates the file at full size before anything is written: fill a temporary file
+    # and only move it to path once complete, so that an interrupted fill is never reused
+    cache = np.memmap(path + '.tmp', dtype=np.uint8, mode='w+', shape=shape)
+    for start_idx in range(0, len(data), chunk_size):
+        imgs, label = get_batch(data, indices[start_idx:start_idx + chunk_size])
+        for k in range(n_copies):
+            cache[k, start_idx:start_idx + len(label)] = binarize_image(imgs).byte().numpy()
+    cache.flush()
+    del cache
+    os.replace(path + '.tmp', path)
+    # the sidecar last: a cache without one is never reused
+    torch.save({'fingerprint': fingerprint, 'labels': labels}, meta_path + '.tmp')
+    os.replace(meta_path + '.tmp', meta_path)
+
+    cache = np.memmap(path, dtype=np.uint8, mode='r', shape=shape)
+    return BinarizedDataset(cache, labels)
+
+
+# scripted so that the elementwise chains below are fused into fewer kernels
+@torch.jit.script
+def preprocess(img, n_bits: int, noise: Optional[torch.Tensor] = None):
     n_bins = 2. ** n_bits
-    # rescale to 255
-    img = img.mul(255)
+    # rescale to 255 (uint8 images are already in [0, 255])
+    if img.dtype == torch.uint8:
+        img = img.float()
+    else:
+        img = img.mul(255)
     if n_bits < 8:
         img = torch.floor(img.div(256. / n_bins))
 
@@ -181,7 +354,8 @@ def preprocess(img, n_bits, noise=None):
     return img
 
 
-def postprocess(img, n_bits):
+@torch.jit.script
+def postprocess(img, n_bits: int):
     n_bins = 2. ** n_bits
     # re-normalize
     img = img.mul(0.5) + 0.5
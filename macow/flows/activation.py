@@ -10,7 +10,7 @@ from macow.flows.flow import Flow
 from macow.utils import logPlusOne
 
 
-class IdentityFlow(Flow):
+class IdentityFlow(Flow, name='identity'):
     def __init__(self, inverse=False):
         super(IdentityFlow, self).__init__(inverse)
 
@@ -58,7 +58,7 @@ class IdentityFlow(Flow):
         return IdentityFlow(**params)
 
 
-class PowshrinkFlow(Flow):
+class PowshrinkFlow(Flow, name='power_shrink'):
     def __init__(self, exponent=2.0, inverse=False):
         super(PowshrinkFlow, self).__init__(inverse)
         assert exponent >= 1.0, 'exponent should be greater or equal to 1.0'
@@ -122,7 +122,7 @@ class PowshrinkFlow(Flow):
         return PowshrinkFlow(**params)
 
 
-class LeakyReLUFlow(Flow):
+class LeakyReLUFlow(Flow, name='leaky_relu'):
     def __init__(self, negative_slope=0.1, inverse=False):
         super(LeakyReLUFlow, self).__init__(inverse)
         assert negative_slope > 0.0, 'negative slope should be positive'
@@ -181,7 +181,7 @@ class LeakyReLUFlow(Flow):
         return LeakyReLUFlow(**params)
 
 
-class ELUFlow(Flow):
+class ELUFlow(Flow, name='elu'):
     def __init__(self, alpha=1.0, inverse=False):
         super(ELUFlow, self).__init__(inverse)
         self.alpha = alpha
@@ -243,7 +243,25 @@ class ELUFlow(Flow):
         return ELUFlow(**params)
 
 
-class SigmoidFlow(Flow):
+# the sigmoid flow is a chain of elementwise ops followed by a reduction; scripting fuses the chain
+@torch.jit.script
+def _sigmoid_fwd(input: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    out = input.sigmoid()
+    logdet = F.softplus(input) + F.softplus(-input)
+    logdet = logdet.flatten(1).sum(dim=1) * -1.
+    return out, logdet
+
+
+@torch.jit.script
+def _sigmoid_bwd(input: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    eps = 1e-12
+    out = torch.log(torch.reciprocal(input + eps) - 1. + eps) * -1.
+    logdet = torch.log(input + eps) + torch.log((1. - input) + eps)
+    logdet = logdet.flatten(1).sum(dim=1) * -1.
+    return out, logdet
+
+
+class SigmoidFlow(Flow, name='sigmoid'):
     def __init__(self, inverse=False):
         super(SigmoidFlow, self).__init__(inverse)
 
@@ -260,10 +278,7 @@ class SigmoidFlow(Flow):
             logdet: [batch], the log determinant of :math:`\partial output / \partial input`
 
         """
-        out = input.sigmoid()
-        logdet = F.softplus(input) + F.softplus(-input)
-        logdet = logdet.view(logdet.size(0), -1).sum(dim=1) * -1.
-        return out, logdet
+        return _sigmoid_fwd(input)
 
     # @overrides
     def backward(self, input: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -278,11 +293,7 @@ class SigmoidFlow(Flow):
             logdet: [batch], the log determinant of :math:`\partial output / \partial input`
 
         """
-        eps = 1e-12
-        out = torch.log(torch.reciprocal(input + eps) - 1.  + eps) * -1.
-        logdet = torch.log(input + eps) + torch.log((1. - input) + eps)
-        logdet = logdet.view(logdet.size(0), -1).sum(dim=1) * -1.
-        return out, logdet
+        return _sigmoid_bwd(input)
 
     # @overrides
     def init(self, data, init_scale=1.0) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -296,10 +307,3 @@ class SigmoidFlow(Flow):
     @classmethod
     def from_params(cls, params: Dict) -> "SigmoidFlow":
         return SigmoidFlow(**params)
-
-
-PowshrinkFlow.register('power_shrink')
-LeakyReLUFlow.register('leaky_relu')
-ELUFlow.register('elu')
-IdentityFlow.register('identity')
-SigmoidFlow.register('sigmoid')
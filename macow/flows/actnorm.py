@@ -10,7 +10,7 @@ from torch.nn import Parameter
 from macow.flows.flow import Flow
 
 
-class ActNormFlow(Flow):
+class ActNormFlow(Flow, name='actnorm'):
     def __init__(self, in_features, inverse=False):
         super(ActNormFlow, self).__init__(inverse)
         self.in_features = in_features
@@ -95,7 +95,7 @@ class ActNormFlow(Flow):
         return ActNormFlow(**params)
 
 
-class ActNorm2dFlow(Flow):
+class ActNorm2dFlow(Flow, name='actnorm2d'):
     def __init__(self, in_channels, inverse=False):
         super(ActNorm2dFlow, self).__init__(inverse)
         self.in_channels = in_channels
@@ -166,7 +166,3 @@ class ActNorm2dFlow(Flow):
     @classmethod
     def from_params(cls, params: Dict) -> "ActNorm2dFlow":
         return ActNorm2dFlow(**params)
-
-
-ActNormFlow.register('actnorm')
-ActNorm2dFlow.register('actnorm2d')
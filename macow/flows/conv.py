@@ -10,11 +10,11 @@ from torch.nn import Parameter
 from torch.nn.modules.utils import _pair
 
 from macow.flows.flow import Flow
-from macow.utils import norm
+from macow.utils import norm, affine_fwd, affine_inv
 from macow.nnet.weight_norm import Conv2dWeightNorm, ShiftedConv2d
 
 
-class Conv1x1Flow(Flow):
+class Conv1x1Flow(Flow, name='conv1x1'):
     def __init__(self, in_channels, inverse=False):
         super(Conv1x1Flow, self).__init__(inverse)
         self.in_channels = in_channels
@@ -97,7 +97,7 @@ class MCFBlock(nn.Module):
         return c
 
 
-class MaskedConvFlow(Flow):
+class MaskedConvFlow(Flow, name='masked_conv'):
     """
     Masked Convolutional Flow
     """
@@ -114,6 +114,7 @@ class MaskedConvFlow(Flow):
         out_channels = in_channels
         if scale:
             out_channels = out_channels * 2
+        self.hidden_channels = hidden_channels
         self.kernel_size = kernel_size
         self.order = order
         self.net = MCFBlock(in_channels, out_channels, kernel_size, hidden_channels, order)
@@ -122,24 +123,6 @@ class MaskedConvFlow(Flow):
         else:
             self.s_conv = Conv2dWeightNorm(s_channels, hidden_channels, (3, 3), bias=True, padding=1)
 
-    def calc_mu_and_scale(self, x: torch.Tensor, s=None, shifted=True):
-        mu = self.net(x, s=s, shifted=shifted)
-        scale = None
-        if self.scale:
-            mu, log_scale = mu.chunk(2, dim=1)
-            # scale = log_scale.add_(2.).sigmoid_()
-            scale = log_scale.add(2.).sigmoid_()
-        return mu, scale
-
-    def init_net(self, x, s=None, init_scale=1.0):
-        mu = self.net.init(x, s=s, init_scale=init_scale)
-        scale = None
-        if self.scale:
-            mu, log_scale = mu.chunk(2, dim=1)
-            # scale = log_scale.add_(2.).sigmoid_()
-            scale = log_scale.add(2.).sigmoid_()
-        return mu, scale
-
     # @overrides
     def forward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
         """
@@ -155,14 +138,12 @@ class MaskedConvFlow(Flow):
         """
         if self.s_conv is not None:
             s = self.s_conv(s)
-        mu, scale = self.calc_mu_and_scale(input, s=s)
-        out = input
+        raw = self.net(input, s=s)
         if self.scale:
-            out = out.mul(scale)
-            logdet = scale.log().view(mu.size(0), -1).sum(dim=1)
+            out, logdet = affine_fwd(raw, input)
         else:
-            logdet = mu.new_zeros(mu.size(0))
-        out = out + mu
+            out = input + raw
+            logdet = raw.new_zeros(raw.size(0))
         return out, logdet
 
     def backward_height(self, input: torch.Tensor, s=None, reverse=False) -> torch.Tensor:
@@ -183,12 +164,10 @@ class MaskedConvFlow(Flow):
             # [batch, channels, width]
             in_curr = input[:, :, h]
 
-            # [batch, channels, 1, width]
-            mu, scale = self.calc_mu_and_scale(out_curr, s=s_curr, shifted=False)
+            # [batch, out_channels, 1, width] -> [batch, out_channels, width]
+            raw = self.net(out_curr, s=s_curr, shifted=False).squeeze(2)
             # [batch, channels, width]
-            new_out = in_curr - mu.squeeze(2)
-            if self.scale:
-                new_out = new_out.div(scale.squeeze(2) + 1e-12)
+            new_out = affine_inv(raw, in_curr) if self.scale else in_curr - raw
             out[:, :, curr_h, cW:W + cW] = new_out
 
         out = out[:, :, :H, cW:cW + W] if reverse else out[:, :, kH:, cW:cW + W]
@@ -212,12 +191,10 @@ class MaskedConvFlow(Flow):
             # [batch, channels, height]
             in_curr = input[:, :, :, w]
 
-            # [batch, channels, height, 1]
-            mu, scale = self.calc_mu_and_scale(out_curr, s=s_curr, shifted=False)
+            # [batch, out_channels, height, 1] -> [batch, out_channels, height]
+            raw = self.net(out_curr, s=s_curr, shifted=False).squeeze(3)
             # [batch, channels, height]
-            new_out = in_curr - mu.squeeze(3)
-            if self.scale:
-                new_out = new_out.div(scale.squeeze(3) + 1e-12)
+            new_out = affine_inv(raw, in_curr) if self.scale else in_curr - raw
             out[:, :, cH:H + cH, curr_w] = new_out
 
         out = out[:, :, cH:cH + H, :W] if reverse else out[:, :, cH:cH + H, kW:]
@@ -255,20 +232,14 @@ class MaskedConvFlow(Flow):
     def init(self, data, s=None, init_scale=1.0) -> Tuple[torch.Tensor, torch.Tensor]:
         if self.s_conv is not None:
             s = self.s_conv.init(s, init_scale=init_scale)
-        mu, scale = self.init_net(data, s=s, init_scale=init_scale)
-        out = data
+        raw = self.net.init(data, s=s, init_scale=init_scale)
         if self.scale:
-            out = out.mul(scale)
-            logdet = scale.log().view(mu.size(0), -1).sum(dim=1)
+            out, logdet = affine_fwd(raw, data)
         else:
-            logdet = mu.new_zeros(mu.size(0))
-        out = out + mu
+            out = data + raw
+            logdet = raw.new_zeros(raw.size(0))
         return out, logdet
 
     @classmethod
     def from_params(cls, params: Dict) -> "MaskedConvFlow":
         return MaskedConvFlow(**params)
-
-
-Conv1x1Flow.register('conv1x1')
-MaskedConvFlow.register('masked_conv')
@@ -1,7 +1,7 @@
 __author__ = 'max'
 
-from overrides import overrides
 from collections import OrderedDict
+from contextlib import nullcontext
 from typing import Dict, Tuple
 import torch
 import torch.nn as nn
@@ -14,8 +14,16 @@ from macow.nnet.weight_norm import Conv2dWeightNorm, ConvTranspose2dWeightNorm
 
 
 class DeQuantFlow(Flow):
-    def __init__(self, levels, num_steps, in_channels, kernel_size, factors, hidden_channels, s_channels=0, scale=True, bottom=True):
+    def __init__(self, levels, num_steps, in_channels, kernel_size, factors, hidden_channels, s_channels=0, scale=True, bottom=True,
+                 cache_s=False, compile=False, amp_dtype=None, channels_last=False):
         super(DeQuantFlow, self).__init__(False)
+        # run the encoder and MaCow under autocast with this dtype (e.g. 'bfloat16'), None disables it
+        self.amp_dtype = getattr(torch, amp_dtype) if isinstance(amp_dtype, str) else amp_dtype
+        # reuse the encoded s across consecutive calls with the same s tensor (opt-in, evaluation only).
+        # The compiled encoder's output lives in a CUDA graph buffer that the next replay overwrites.
+        assert not (cache_s and compile), 'cache_s cannot be combined with compile'
+        self.cache_s = cache_s
+        self._s_cache = (None, None)
         self.macow = MaCow(levels, num_steps, in_channels, kernel_size, factors,
                            hidden_channels=hidden_channels, s_channels=s_channels, scale=scale, inverse=False, bottom=bottom)
         self.sigmoid = SigmoidFlow(inverse=False)
@@ -49,43 +57,108 @@ class DeQuantFlow(Flow):
             assert len(out_planes) == 0
             layers.append(('s_level', Conv2dWeightNorm(planes, s_channels, 1, bias=True)))
             self.encoder = nn.Sequential(OrderedDict(layers))
+            # (is_elu, layer) pairs so that init_encoder does not re-check layer types
+            self._init_plan = [(isinstance(layer, nn.ELU), layer) for layer in self.encoder]
         else:
             self.encoder = None
+            self._init_plan = None
+        # compiled (inductor + CUDA graphs) encoder for forward/backward, opt-in. It is kept outside
+        # the module registry so that parameter names and checkpoints stay the same as for self.encoder.
+        # init_encoder always runs eagerly.
+        self._compiled_encoder = None
+        if compile and self.encoder is not None and torch.cuda.is_available():
+            object.__setattr__(self, '_compiled_encoder',
+                               torch.compile(self.encoder, mode='reduce-overhead', fullgraph=False))
+        # run the encoder and MaCow on NHWC (channels_last) activations and conv weights, opt-in
+        self.channels_last = False
+        if channels_last:
+            self.set_channels_last()
+
+    def set_channels_last(self, enabled=True):
+        self.channels_last = enabled
+        self.macow.set_channels_last(enabled)
+        if self.encoder is not None:
+            self.encoder.to(memory_format=torch.channels_last if enabled else torch.contiguous_format)
+
+    def _format(self, s):
+        # the encoder is a pure conv stack, in NHWC it runs on the cuDNN channels_last kernels
+        return s.contiguous(memory_format=torch.channels_last) if self.channels_last else s
 
     def init_encoder(self, s, init_scale=1.0) -> torch.Tensor:
-        out = s
-        for layer in self.encoder:
-            if isinstance(layer, nn.ELU):
-                out = layer(out)
-            else:
-                out = layer.init(out, init_scale=init_scale)
+        out = self._format(s)
+        for is_elu, layer in self._init_plan:
+            out = layer(out) if is_elu else layer.init(out, init_scale=init_scale)
         return out
 
-    # @overrides
+    def run_encoder(self, s) -> torch.Tensor:
+        s = self._format(s)
+        if self._compiled_encoder is not None:
+            return self._compiled_encoder(s)
+        return self.encoder(s)
+
+    def encode_s(self, s) -> torch.Tensor:
+        """
+        Run the encoder on s, reusing the previous result if the same s tensor was seen last.
+        The cache is only used in eval mode without grad, and is cleared whenever the flow is
+        switched between train and eval mode; call reset_cache() if s is modified in place.
+        """
+        if not self.cache_s or self.training or torch.is_grad_enabled():
+            # the parameters may change between calls, never keep an encoding across them
+            self._s_cache = (None, None)
+            return self.run_encoder(s)
+        s_in, s_out = self._s_cache
+        if s_in is s:
+            return s_out
+        s_out = self.run_encoder(s)
+        self._s_cache = (s, s_out)
+        return s_out
+
+    def reset_cache(self):
+        self._s_cache = (None, None)
+
+    def train(self, mode=True):
+        self.reset_cache()
+        return super(DeQuantFlow, self).train(mode)
+
+    def _replicate_for_data_parallel(self):
+        replica = super(DeQuantFlow, self)._replicate_for_data_parallel()
+        # the compiled encoder is bound to the original module, replicas run eagerly
+        object.__setattr__(replica, '_compiled_encoder', None)
+        replica._s_cache = (None, None)
+        return replica
+
+    def autocast(self, input: torch.Tensor):
+        # without an amp_dtype of its own, leave any autocast of the caller in effect
+        # (autocast(enabled=False) would switch it off)
+        if self.amp_dtype is None:
+            return nullcontext()
+        return torch.autocast(input.device.type, dtype=self.amp_dtype)
+
     def forward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
-        if self.encoder is not None:
-            s = self.encoder(s)
-        out, logdet_accum = self.macow.forward(input, s=s)
-        out, logdet = self.sigmoid.forward(out)
-        logdet_accum = logdet_accum + logdet
+        with self.autocast(input):
+            if self.encoder is not None:
+                s = self.encode_s(s)
+            out, logdet_accum = self.macow.forward(input, s=s)
+        # the sigmoid and the logdet accumulator stay in fp32
+        out, logdet = self.sigmoid.forward(out.float())
+        logdet_accum = logdet_accum.float().add_(logdet)
         return out, logdet_accum
 
-    # @overrides
     def backward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
-        if self.encoder is not None:
-            s = self.encoder(s)
         out, logdet_accum = self.sigmoid.backward(input)
-        out, logdet = self.macow.backward(out, s=s)
-        logdet_accum = logdet_accum + logdet
-        return out, logdet_accum
+        with self.autocast(input):
+            if self.encoder is not None:
+                s = self.encode_s(s)
+            out, logdet = self.macow.backward(out, s=s)
+        logdet_accum = logdet_accum.add_(logdet.float())
+        return out.float(), logdet_accum
 
-    # @overrides
     def init(self, data, s=None, init_scale=1.0) -> Tuple[torch.Tensor, torch.Tensor]:
         if self.encoder is not None:
             s = self.init_encoder(s, init_scale=init_scale)
         out, logdet_accum = self.macow.init(data, s=s, init_scale=init_scale)
         out, logdet = self.sigmoid.init(out, init_scale=init_scale)
-        logdet_accum = logdet_accum + logdet
+        logdet_accum = logdet_accum.add_(logdet)
         return out, logdet_accum
 
     @classmethod
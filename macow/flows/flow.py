@@ -1,19 +1,122 @@
 __author__ = 'max'
 
-from typing import Dict, Tuple
+import threading
+from typing import Dict, List, Optional, Tuple
 import torch
 import torch.nn as nn
 
 
+def sum_logdets(logdets: List[torch.Tensor], input: torch.Tensor) -> torch.Tensor:
+    """
+    Sum a list of [batch] log determinants with a single reduction
+    instead of a chain of pairwise additions.
+    """
+    if len(logdets) == 0:
+        return input.new_zeros(input.size(0))
+    if len(logdets) == 1:
+        return logdets[0]
+    return torch.stack(logdets, dim=0).sum(dim=0)
+
+
+def add_logdet(logdet_accum: torch.Tensor, logdet: Optional[torch.Tensor], batch: int) -> torch.Tensor:
+    """
+    Add logdet to logdet_accum, treating None as a zero log determinant.
+    The result is always [batch] (broadcast without allocation if logdet is None).
+    """
+    if logdet is None:
+        return logdet_accum.expand(batch)
+    return logdet_accum + logdet
+
+
 class Flow(nn.Module):
     """
     Normalizing Flow base class
+
+    forward/backward/init return (out, logdet). Volume-preserving internal flows may return None
+    as logdet instead of allocating a zero tensor; their callers treat it as 0 (see add_logdet).
+    fwdpass/bwdpass always return a logdet tensor.
+
+    Subclasses that can be built from a config are registered on definition under the name given
+    as class keyword, e.g. ``class Conv1x1Flow(Flow, name='conv1x1')``. Internal flows (blocks,
+    steps, parallel wrappers) are defined without a name and stay out of the registry.
     """
     _registry = dict()
+    _registry_lock = threading.Lock()
+
+    def __init_subclass__(cls, name: str = None, **kwargs):
+        super(Flow, cls).__init_subclass__(**kwargs)
+        if name is not None:
+            cls.register(name)
 
     def __init__(self, inverse):
         super(Flow, self).__init__()
         self.inverse = inverse
+        self._finalized = False
+        self._flat_named = None
+        self._logdet_buf = None
+        self._bind_passes()
+
+    def _bind_passes(self):
+        # resolve the direction once instead of branching on self.inverse in every fwdpass/bwdpass.
+        # The plain functions are stored, called with self: bound methods would make every flow a
+        # reference cycle, and would still point to the original module in DataParallel replicas.
+        cls = type(self)
+        self._fwd_impl = cls.backward if self.inverse else cls.forward
+        self._bwd_impl = cls.forward if self.inverse else cls.backward
+
+    def finalize(self):
+        """
+        Mark the flow as fully built. From then on parameters() and named_parameters() are served
+        from a cached flat list instead of walking the module tree on every call.
+        The cache is rebuilt after parameters or submodules of this flow are reassigned,
+        after the flow is moved or cast, and after a state dict is loaded.
+        """
+        self._finalized = True
+        self._flat_named = None
+
+    def __setattr__(self, name, value):
+        if isinstance(value, (nn.Parameter, nn.Module)):
+            self.__dict__['_flat_named'] = None
+        super(Flow, self).__setattr__(name, value)
+
+    def _apply(self, fn, *args, **kwargs):
+        self._flat_named = None
+        return super(Flow, self)._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._flat_named = None
+        super(Flow, self)._load_from_state_dict(*args, **kwargs)
+
+    def _replicate_for_data_parallel(self):
+        replica = super(Flow, self)._replicate_for_data_parallel()
+        replica._flat_named = None
+        replica._logdet_buf = None
+        return replica
+
+    def _zero_logdet(self, input: torch.Tensor) -> torch.Tensor:
+        """
+        [batch] zeros to start a logdet accumulation. With grad disabled a per-flow buffer is zeroed
+        and reused instead of allocated, so callers must accumulate into it out of place.
+        """
+        if torch.is_grad_enabled():
+            return input.new_zeros(input.size(0))
+        buf = self._logdet_buf
+        if buf is None or buf.size(0) != input.size(0) or buf.device != input.device or buf.dtype != input.dtype:
+            buf = input.new_zeros(input.size(0))
+            self._logdet_buf = buf
+        else:
+            buf.zero_()
+        return buf
+
+    def named_parameters(self, prefix='', recurse=True, *args, **kwargs):
+        if not self._finalized or prefix or not recurse or args or kwargs:
+            return super(Flow, self).named_parameters(prefix, recurse, *args, **kwargs)
+        if self._flat_named is None:
+            self._flat_named = list(super(Flow, self).named_parameters())
+        return iter(self._flat_named)
+
+    def parameters(self, recurse=True):
+        return (param for _, param in self.named_parameters(recurse=recurse))
 
     def forward(self, input: torch.Tensor, **kwargs) -> Tuple[torch.Tensor, torch.Tensor]:
         """
@@ -61,16 +164,15 @@ class Flow(nn.Module):
             Then the density :math:`\log(p(y)) = \log(p(x)) - logdet`
 
         """
-        if self.inverse:
-            if init:
+        if init:
+            if self.inverse:
                 raise RuntimeError('inverse flow shold be initialized with backward pass')
-            else:
-                return self.backward(x, *h, **kwargs)
+            out, logdet = self.init(x, *h, init_scale=init_scale, **kwargs)
         else:
-            if init:
-                return self.init(x, *h, init_scale=init_scale, **kwargs)
-            else:
-                return self.forward(x, *h, **kwargs)
+            out, logdet = self._fwd_impl(self, x, *h, **kwargs)
+        if logdet is None:
+            logdet = x.new_zeros(x.size(0))
+        return out, logdet
 
     def bwdpass(self, y: torch.Tensor, *h, init=False, init_scale=1.0, **kwargs) -> Tuple[torch.Tensor, torch.Tensor]:
         """
@@ -91,24 +193,27 @@ class Flow(nn.Module):
             Then the density :math:`\log(p(y)) = \log(p(x)) + logdet`
 
         """
-        if self.inverse:
-            if init:
-                return self.init(y, *h, init_scale=init_scale, **kwargs)
-            else:
-                return self.forward(y, *h, **kwargs)
-        else:
-            if init:
+        if init:
+            if not self.inverse:
                 raise RuntimeError('forward flow should be initialzed with forward pass')
-            else:
-                return self.backward(y, *h, **kwargs)
+            out, logdet = self.init(y, *h, init_scale=init_scale, **kwargs)
+        else:
+            out, logdet = self._bwd_impl(self, y, *h, **kwargs)
+        if logdet is None:
+            logdet = y.new_zeros(y.size(0))
+        return out, logdet
 
     @classmethod
     def register(cls, name: str):
-        Flow._registry[name] = cls
+        with Flow._registry_lock:
+            Flow._registry[name] = cls
 
     @classmethod
     def by_name(cls, name: str):
-        return Flow._registry[name]
+        flow = Flow._registry.get(name)
+        if flow is None:
+            raise ValueError('unknown flow: %s (registered: %s)' % (name, ', '.join(sorted(Flow._registry))))
+        return flow
 
     @classmethod
     def from_params(cls, params: Dict):
@@ -6,7 +6,7 @@ import torch
 import torch.nn as nn
 from torch.nn import Parameter
 
-from macow.flows.flow import Flow
+from macow.flows.flow import Flow, add_logdet
 from macow.flows.actnorm import ActNorm2dFlow
 from macow.flows.conv import Conv1x1Flow
 from macow.flows.nice import NICE
@@ -35,17 +35,30 @@ class Prior(Flow):
         logdet_accum = logdet_accum + logdet
 
         out, logdet = self.nice.forward(out, s=s)
-        logdet_accum = logdet_accum + logdet
+        logdet_accum = add_logdet(logdet_accum, logdet, out.size(0))
         return out, logdet_accum
 
-    def backward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
-        out, logdet_accum = self.nice.backward(input, s=s)
+    def forward_split(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        forward returning the two halves split at z1_channels instead of their concatenation
+        """
+        out, logdet_accum = self.actnorm.forward(input)
 
-        out, logdet = self.conv1x1.backward(out)
+        out, logdet = self.conv1x1.forward(out)
         logdet_accum = logdet_accum + logdet
 
+        z1, z2, logdet = self.nice.forward_split(out, s=s)
+        logdet_accum = add_logdet(logdet_accum, logdet, out.size(0))
+        return z1, z2, logdet_accum
+
+    def backward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
+        out, logdet_coupling = self.nice.backward(input, s=s)
+
+        out, logdet_accum = self.conv1x1.backward(out)
+
         out, logdet = self.actnorm.backward(out)
         logdet_accum = logdet_accum + logdet
+        logdet_accum = add_logdet(logdet_accum, logdet_coupling, out.size(0))
         return out, logdet_accum
 
     # @overrides
@@ -56,7 +69,7 @@ class Prior(Flow):
         logdet_accum = logdet_accum + logdet
 
         out, logdet = self.nice.init(out, s=s, init_scale=init_scale)
-        logdet_accum = logdet_accum + logdet
+        logdet_accum = add_logdet(logdet_accum, logdet, out.size(0))
         return out, logdet_accum
 
 
@@ -83,18 +96,18 @@ class GlowStep(Flow):
         logdet_accum = logdet_accum + logdet
 
         out, logdet = self.coupling.forward(out, s=s)
-        logdet_accum = logdet_accum + logdet
+        logdet_accum = add_logdet(logdet_accum, logdet, out.size(0))
         return out, logdet_accum
 
     # @overrides
     def backward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
-        out, logdet_accum = self.coupling.backward(input, s=s)
+        out, logdet_coupling = self.coupling.backward(input, s=s)
 
-        out, logdet = self.conv1x1.backward(out)
-        logdet_accum = logdet_accum + logdet
+        out, logdet_accum = self.conv1x1.backward(out)
 
         out, logdet = self.actnorm.backward(out)
         logdet_accum = logdet_accum + logdet
+        logdet_accum = add_logdet(logdet_accum, logdet_coupling, out.size(0))
         return out, logdet_accum
 
     # @overrides
@@ -105,7 +118,7 @@ class GlowStep(Flow):
         logdet_accum = logdet_accum + logdet
 
         out, logdet = self.coupling.init(out, s=s, init_scale=init_scale)
-        logdet_accum = logdet_accum + logdet
+        logdet_accum = add_logdet(logdet_accum, logdet, out.size(0))
         return out, logdet_accum
 
 
@@ -126,7 +139,7 @@ class GlowTopBlock(Flow):
     def forward(self, input: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         out = input
         # [batch]
-        logdet_accum = input.new_zeros(input.size(0))
+        logdet_accum = self._zero_logdet(input)
         for step in self.steps:
             out, logdet = step.forward(out)
             logdet_accum = logdet_accum + logdet
@@ -134,7 +147,7 @@ class GlowTopBlock(Flow):
 
     # @overrides
     def backward(self, input: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
-        logdet_accum = input.new_zeros(input.size(0))
+        logdet_accum = self._zero_logdet(input)
         out = input
         for step in reversed(self.steps):
             out, logdet = step.backward(out)
@@ -145,7 +158,7 @@ class GlowTopBlock(Flow):
     def init(self, data, init_scale=1.0) -> Tuple[torch.Tensor, torch.Tensor]:
         out = data
         # [batch]
-        logdet_accum = data.new_zeros(data.size(0))
+        logdet_accum = self._zero_logdet(data)
         for step in self.steps:
             out, logdet = step.init(out, init_scale=init_scale)
             logdet_accum = logdet_accum + logdet
@@ -171,7 +184,7 @@ class GlowInternalBlock(Flow):
     def forward(self, input: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         out = input
         # [batch]
-        logdet_accum = input.new_zeros(input.size(0))
+        logdet_accum = self._zero_logdet(input)
         for step in self.steps:
             out, logdet = step.forward(out)
             logdet_accum = logdet_accum + logdet
@@ -192,7 +205,7 @@ class GlowInternalBlock(Flow):
     def init(self, data, init_scale=1.0) -> Tuple[Tuple[torch.Tensor, torch.Tensor], torch.Tensor]:
         out = data
         # [batch]
-        logdet_accum = data.new_zeros(data.size(0))
+        logdet_accum = self._zero_logdet(data)
         for step in self.steps:
             out, logdet = step.init(out, init_scale=init_scale)
             logdet_accum = logdet_accum + logdet
@@ -201,7 +214,7 @@ class GlowInternalBlock(Flow):
         return out, logdet_accum
 
 
-class Glow(Flow):
+class Glow(Flow, name='glow'):
     """
     Glow
     """
@@ -229,7 +242,7 @@ class Glow(Flow):
 
     # @overrides
     def forward(self, input: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
-        logdet_accum = input.new_zeros(input.size(0))
+        logdet_accum = self._zero_logdet(input)
         out = input
         outputs = []
         for i, block in enumerate(self.blocks):
@@ -257,7 +270,7 @@ class Glow(Flow):
             outputs.append(out2)
             out = squeeze2d(out1, factor=2)
 
-        logdet_accum = input.new_zeros(input.size(0))
+        logdet_accum = self._zero_logdet(input)
         for i, block in enumerate(reversed(self.blocks)):
             if isinstance(block, GlowInternalBlock):
                 out2 = outputs.pop()
@@ -270,7 +283,7 @@ class Glow(Flow):
 
     # @overrides
     def init(self, data, init_scale=1.0) -> Tuple[torch.Tensor, torch.Tensor]:
-        logdet_accum = data.new_zeros(data.size(0))
+        logdet_accum = self._zero_logdet(data)
         out = data
         outputs = []
         for i, block in enumerate(self.blocks):
@@ -292,6 +305,3 @@ class Glow(Flow):
     @classmethod
     def from_params(cls, params: Dict) -> "Glow":
         return Glow(**params)
-
-
-Glow.register('glow')
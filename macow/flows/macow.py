@@ -1,14 +1,14 @@
 __author__ = 'max'
 
-from overrides import overrides
 from typing import Dict, Tuple
 import torch
 import torch.nn as nn
 
-from macow.flows.flow import Flow
+from macow.flows.flow import Flow, sum_logdets
 from macow.flows.actnorm import ActNorm2dFlow
 from macow.flows.conv import MaskedConvFlow
-from macow.utils import squeeze2d, unsqueeze2d, split2d, unsplit2d
+from macow.nnet.weight_norm import Conv2dWeightNorm
+from macow.utils import squeeze2d, unsqueeze2d, graph_key, capture_cuda_graph, replay_cuda_graph
 from macow.flows.glow import GlowStep, Prior
 
 
@@ -20,71 +20,83 @@ class MaCowUnit(Flow):
         super(MaCowUnit, self).__init__(inverse)
         self.actnorm1 = ActNorm2dFlow(in_channels, inverse=inverse)
         self.actnorm2 = ActNorm2dFlow(in_channels, inverse=inverse)
-        self.conv1 = MaskedConvFlow(in_channels, (kernel_size[0], kernel_size[1]), s_channels=s_channels, order='A', scale=scale, inverse=inverse)
-        self.conv2 = MaskedConvFlow(in_channels, (kernel_size[0], kernel_size[1]), s_channels=s_channels, order='B', scale=scale, inverse=inverse)
-        self.conv3 = MaskedConvFlow(in_channels, (kernel_size[1], kernel_size[0]), s_channels=s_channels, order='C', scale=scale, inverse=inverse)
-        self.conv4 = MaskedConvFlow(in_channels, (kernel_size[1], kernel_size[0]), s_channels=s_channels, order='D', scale=scale, inverse=inverse)
+        # the MCFs get the already projected s, see s_conv below
+        self.conv1 = MaskedConvFlow(in_channels, (kernel_size[0], kernel_size[1]), s_channels=None, order='A', scale=scale, inverse=inverse)
+        self.conv2 = MaskedConvFlow(in_channels, (kernel_size[0], kernel_size[1]), s_channels=None, order='B', scale=scale, inverse=inverse)
+        self.conv3 = MaskedConvFlow(in_channels, (kernel_size[1], kernel_size[0]), s_channels=None, order='C', scale=scale, inverse=inverse)
+        self.conv4 = MaskedConvFlow(in_channels, (kernel_size[1], kernel_size[0]), s_channels=None, order='D', scale=scale, inverse=inverse)
+        # the four MCFs are sequential, but their s projections all read the same s:
+        # compute them with a single conv and split the output along channels.
+        if s_channels is None or s_channels <= 0:
+            self.s_conv = None
+        else:
+            hidden_channels = self.conv1.hidden_channels
+            self.s_conv = Conv2dWeightNorm(s_channels, 4 * hidden_channels, (3, 3), bias=True, padding=1)
+
+    def project_s(self, s, init=False, init_scale=1.0):
+        if self.s_conv is None:
+            return s, s, s, s
+        s = self.s_conv.init(s, init_scale=init_scale) if init else self.s_conv(s)
+        return s.chunk(4, dim=1)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # merge the separate s projections of old checkpoints (conv{1-4}.s_conv.*) into s_conv
+        legacy = [prefix + 'conv%d.s_conv.' % i for i in range(1, 5)]
+        if self.s_conv is not None and legacy[0] + 'conv.weight_v' in state_dict:
+            for name in ['conv.weight_g', 'conv.weight_v', 'conv.bias']:
+                state_dict[prefix + 's_conv.' + name] = torch.cat([state_dict.pop(key + name) for key in legacy], dim=0)
+        super(MaCowUnit, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-    # @overrides
     def forward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
+        s1, s2, s3, s4 = self.project_s(s)
         # ActNorm1
-        out, logdet_accum = self.actnorm1.forward(input)
+        out, logdet_act1 = self.actnorm1.forward(input)
         # MCF1
-        out, logdet = self.conv1.forward(out, s=s)
-        logdet_accum = logdet_accum + logdet
+        out, logdet1 = self.conv1.forward(out, s=s1)
         # MCF2
-        out, logdet = self.conv2.forward(out, s=s)
-        logdet_accum = logdet_accum + logdet
+        out, logdet2 = self.conv2.forward(out, s=s2)
         # ActNorm2
-        out, logdet = self.actnorm2.forward(out)
-        logdet_accum = logdet_accum + logdet
+        out, logdet_act2 = self.actnorm2.forward(out)
         # MCF3
-        out, logdet = self.conv3.forward(out, s=s)
-        logdet_accum = logdet_accum + logdet
+        out, logdet3 = self.conv3.forward(out, s=s3)
         # MCF4
-        out, logdet = self.conv4.forward(out, s=s)
-        logdet_accum = logdet_accum + logdet
+        out, logdet4 = self.conv4.forward(out, s=s4)
+        # actnorm logdets are [1], the MCF ones [batch]
+        logdet_accum = sum_logdets([logdet1, logdet2, logdet3, logdet4], input) + (logdet_act1 + logdet_act2)
         return out, logdet_accum
 
     def backward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
+        s1, s2, s3, s4 = self.project_s(s)
         # MCF4
-        out, logdet_accum = self.conv4.backward(input, s=s)
+        out, logdet4 = self.conv4.backward(input, s=s4)
         # MCF3
-        out, logdet = self.conv3.backward(out, s=s)
-        logdet_accum = logdet_accum + logdet
+        out, logdet3 = self.conv3.backward(out, s=s3)
         # ActNorm2
-        out, logdet = self.actnorm2.backward(out)
-        logdet_accum = logdet_accum + logdet
+        out, logdet_act2 = self.actnorm2.backward(out)
         # MCF2
-        out, logdet = self.conv2.backward(out, s=s)
-        logdet_accum = logdet_accum + logdet
+        out, logdet2 = self.conv2.backward(out, s=s2)
         # MCF1
-        out, logdet = self.conv1.backward(out, s=s)
-        logdet_accum = logdet_accum + logdet
+        out, logdet1 = self.conv1.backward(out, s=s1)
         # ActNorm1
-        out, logdet = self.actnorm1.backward(out)
-        logdet_accum = logdet_accum + logdet
+        out, logdet_act1 = self.actnorm1.backward(out)
+        logdet_accum = sum_logdets([logdet4, logdet3, logdet2, logdet1], input) + (logdet_act2 + logdet_act1)
         return out, logdet_accum
 
-    # @overrides
     def init(self, data, s=None, init_scale=1.0) -> Tuple[torch.Tensor, torch.Tensor]:
+        s1, s2, s3, s4 = self.project_s(s, init=True, init_scale=init_scale)
         # ActNorm1
-        out, logdet_accum = self.actnorm1.init(data, init_scale=init_scale)
+        out, logdet_act1 = self.actnorm1.init(data, init_scale=init_scale)
         # MCF1
-        out, logdet = self.conv1.init(out, s=s, init_scale=init_scale)
-        logdet_accum = logdet_accum + logdet
+        out, logdet1 = self.conv1.init(out, s=s1, init_scale=init_scale)
         # MCF2
-        out, logdet = self.conv2.init(out, s=s, init_scale=init_scale)
-        logdet_accum = logdet_accum + logdet
+        out, logdet2 = self.conv2.init(out, s=s2, init_scale=init_scale)
         # ActNorm2
-        out, logdet = self.actnorm2.init(out, init_scale=init_scale)
-        logdet_accum = logdet_accum + logdet
+        out, logdet_act2 = self.actnorm2.init(out, init_scale=init_scale)
         # MCF3
-        out, logdet = self.conv3.init(out, s=s, init_scale=init_scale)
-        logdet_accum = logdet_accum + logdet
+        out, logdet3 = self.conv3.init(out, s=s3, init_scale=init_scale)
         # MCF4
-        out, logdet = self.conv4.init(out, s=s, init_scale=init_scale)
-        logdet_accum = logdet_accum + logdet
+        out, logdet4 = self.conv4.init(out, s=s4, init_scale=init_scale)
+        logdet_accum = sum_logdets([logdet1, logdet2, logdet3, logdet4], data) + (logdet_act1 + logdet_act2)
         return out, logdet_accum
 
     @classmethod
@@ -108,35 +120,33 @@ class MaCowStep(Flow):
     def sync(self):
         self.glow_step.sync()
 
-    # @overrides
     def forward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
-        logdet_accum = input.new_zeros(input.size(0))
+        logdets = []
         out = input
         for unit in self.units:
             out, logdet = unit.forward(out, s=s)
-            logdet_accum = logdet_accum + logdet
+            logdets.append(logdet)
         out, logdet = self.glow_step.forward(out, s=s)
-        logdet_accum = logdet_accum + logdet
-        return out, logdet_accum
+        logdets.append(logdet)
+        return out, sum_logdets(logdets, input)
 
-    # @overrides
     def backward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
-        out, logdet_accum = self.glow_step.backward(input, s=s)
+        out, logdet = self.glow_step.backward(input, s=s)
+        logdets = [logdet]
         for unit in reversed(self.units):
             out, logdet = unit.backward(out, s=s)
-            logdet_accum = logdet_accum + logdet
-        return out, logdet_accum
+            logdets.append(logdet)
+        return out, sum_logdets(logdets, input)
 
-    # @overrides
     def init(self, data, s=None, init_scale=1.0) -> Tuple[torch.Tensor, torch.Tensor]:
-        logdet_accum = data.new_zeros(data.size(0))
+        logdets = []
         out = data
         for unit in self.units:
             out, logdet = unit.init(out, s=s, init_scale=init_scale)
-            logdet_accum = logdet_accum + logdet
+            logdets.append(logdet)
         out, logdet = self.glow_step.init(out, s=s, init_scale=init_scale)
-        logdet_accum = logdet_accum + logdet
-        return out, logdet_accum
+        logdets.append(logdet)
+        return out, sum_logdets(logdets, data)
 
 
 class MaCowBottomBlock(Flow):
@@ -146,40 +156,40 @@ class MaCowBottomBlock(Flow):
     def __init__(self, num_steps, in_channels, kernel_size, hidden_channels, s_channels, scale=False, inverse=False):
         super(MaCowBottomBlock, self).__init__(inverse)
         steps = [MaCowStep(in_channels, kernel_size, hidden_channels, s_channels, scale=scale, inverse=inverse) for _ in range(num_steps)]
+        # kept as a plain ModuleList loop (also in MaCowTopBlock): the steps cannot be scripted, since
+        # weight_norm recomputes the conv weights in Python hooks and MaskedConvFlow.backward is a
+        # data-dependent Python loop; the logdets are reduced once by sum_logdets
         self.steps = nn.ModuleList(steps)
 
     def sync(self):
         for step in self.steps:
             step.sync()
 
-    # @overrides
     def forward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
         out = input
         # [batch]
-        logdet_accum = input.new_zeros(input.size(0))
+        logdets = []
         for step in self.steps:
             out, logdet = step.forward(out, s=s)
-            logdet_accum = logdet_accum + logdet
-        return out, logdet_accum
+            logdets.append(logdet)
+        return out, sum_logdets(logdets, input)
 
-    # @overrides
     def backward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
-        logdet_accum = input.new_zeros(input.size(0))
+        logdets = []
         out = input
         for step in reversed(self.steps):
             out, logdet = step.backward(out, s=s)
-            logdet_accum = logdet_accum + logdet
-        return out, logdet_accum
+            logdets.append(logdet)
+        return out, sum_logdets(logdets, input)
 
-    # @overrides
     def init(self, data, s=None, init_scale=1.0) -> Tuple[torch.Tensor, torch.Tensor]:
         out = data
         # [batch]
-        logdet_accum = data.new_zeros(data.size(0))
+        logdets = []
         for step in self.steps:
             out, logdet = step.init(out, s=s, init_scale=init_scale)
-            logdet_accum = logdet_accum + logdet
-        return out, logdet_accum
+            logdets.append(logdet)
+        return out, sum_logdets(logdets, data)
 
 
 class MaCowTopBlock(Flow):
@@ -197,34 +207,31 @@ class MaCowTopBlock(Flow):
         for step in self.steps:
             step.sync()
 
-    # @overrides
     def forward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
         out = input
         # [batch]
-        logdet_accum = input.new_zeros(input.size(0))
+        logdets = []
         for step in self.steps:
             out, logdet = step.forward(out, s=s)
-            logdet_accum = logdet_accum + logdet
-        return out, logdet_accum
+            logdets.append(logdet)
+        return out, sum_logdets(logdets, input)
 
-    # @overrides
     def backward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
-        logdet_accum = input.new_zeros(input.size(0))
+        logdets = []
         out = input
         for step in reversed(self.steps):
             out, logdet = step.backward(out, s=s)
-            logdet_accum = logdet_accum + logdet
-        return out, logdet_accum
+            logdets.append(logdet)
+        return out, sum_logdets(logdets, input)
 
-    # @overrides
     def init(self, data, s=None, init_scale=1.0) -> Tuple[torch.Tensor, torch.Tensor]:
         out = data
         # [batch]
-        logdet_accum = data.new_zeros(data.size(0))
+        logdets = []
         for step in self.steps:
             out, logdet = step.init(out, s=s, init_scale=init_scale)
-            logdet_accum = logdet_accum + logdet
-        return out, logdet_accum
+            logdets.append(logdet)
+        return out, sum_logdets(logdets, data)
 
 
 class MaCowInternalBlock(Flow):
@@ -239,7 +246,10 @@ class MaCowInternalBlock(Flow):
         self.layers = nn.ModuleList()
         self.priors = nn.ModuleList()
         channel_step = in_channels // factor
+        # input channels of each layer; the splits are nested channel prefixes of the block input
+        self._layer_channels = []
         for num_step in num_steps:
+            self._layer_channels.append(in_channels)
             layer = [MaCowStep(in_channels, kernel_size, hidden_channels, s_channels, scale=scale, inverse=inverse,
                                coupling_type=coupling_type, slice=slice, heads=heads, pos_enc=pos_enc, dropout=dropout) for _ in range(num_step)]
             self.layers.append(nn.ModuleList(layer))
@@ -250,6 +260,8 @@ class MaCowInternalBlock(Flow):
             factor = factor - 1
         self.z1_channels = in_channels
         assert len(self.layers) == len(self.priors)
+        # channels kept by each prior's split, fixed at construction
+        self._z1_channels_list = [prior.z1_channels for prior in self.priors]
 
     def sync(self):
         for layer, prior in zip(self.layers, self.priors):
@@ -257,81 +269,75 @@ class MaCowInternalBlock(Flow):
                 step.sync()
             prior.sync()
 
-    # @overrides
     def forward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
         out = input
         # [batch]
-        logdet_accum = input.new_zeros(input.size(0))
+        logdets = []
         outputs = []
         for layer, prior in zip(self.layers, self.priors):
             for step in layer:
                 out, logdet = step.forward(out, s=s)
-                logdet_accum = logdet_accum + logdet
-            out, logdet = prior.forward(out, s=s)
-            logdet_accum = logdet_accum + logdet
-            # split
-            out1, out2 = split2d(out, prior.z1_channels)
+                logdets.append(logdet)
+            # the prior splits at its own z1_channels: take the halves directly instead of cat + narrow
+            out, out2, logdet = prior.forward_split(out, s=s)
+            logdets.append(logdet)
             outputs.append(out2)
-            out = out1
 
         outputs.append(out)
         outputs.reverse()
-        out = unsplit2d(outputs)
-        return out, logdet_accum
+        out = torch.cat(outputs, dim=1)
+        return out, sum_logdets(logdets, input)
 
-    # @overrides
     def backward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
-        out = input
-        outputs = []
-        for prior in self.priors:
-            out1, out2 = split2d(out, prior.z1_channels)
-            outputs.append(out2)
-            out = out1
-
+        out = None
         # [batch]
-        logdet_accum = out.new_zeros(out.size(0))
-        for layer, prior in zip(reversed(self.layers), reversed(self.priors)):
-            out2 = outputs.pop()
-            out = unsplit2d([out, out2])
+        logdets = []
+        plan = zip(reversed(self.layers), reversed(self.priors), reversed(self._layer_channels), reversed(self._z1_channels_list))
+        for layer, prior, in_channels, z1_channels in plan:
+            if out is None:
+                # nothing transformed yet: the joined input of the last prior is a prefix of input (a view)
+                out = input.narrow(1, 0, in_channels)
+            else:
+                out = torch.cat([out, input.narrow(1, z1_channels, in_channels - z1_channels)], dim=1)
             out, logdet = prior.backward(out, s=s)
-            logdet_accum = logdet_accum + logdet
+            logdets.append(logdet)
             for step in reversed(layer):
                 out, logdet = step.backward(out, s=s)
-                logdet_accum = logdet_accum + logdet
+                logdets.append(logdet)
 
-        assert len(outputs) == 0
-        return out, logdet_accum
+        return out, sum_logdets(logdets, input)
 
-    # @overrides
     def init(self, data, s=None, init_scale=1.0) -> Tuple[Tuple[torch.Tensor, torch.Tensor], torch.Tensor]:
         out = data
         # [batch]
-        logdet_accum = data.new_zeros(data.size(0))
+        logdets = []
         outputs = []
-        for layer, prior in zip(self.layers, self.priors):
+        for layer, prior, z1_channels in zip(self.layers, self.priors, self._z1_channels_list):
             for step in layer:
                 out, logdet = step.init(out, s=s, init_scale=init_scale)
-                logdet_accum = logdet_accum + logdet
+                logdets.append(logdet)
             out, logdet = prior.init(out, s=s, init_scale=init_scale)
-            logdet_accum = logdet_accum + logdet
-            # split
-            out1, out2 = split2d(out, prior.z1_channels)
-            outputs.append(out2)
-            out = out1
+            logdets.append(logdet)
+            # split (views)
+            outputs.append(out.narrow(1, z1_channels, out.size(1) - z1_channels))
+            out = out.narrow(1, 0, z1_channels)
 
         outputs.append(out)
         outputs.reverse()
-        out = unsplit2d(outputs)
-        return out, logdet_accum
+        out = torch.cat(outputs, dim=1)
+        return out, sum_logdets(logdets, data)
 
 
-class MaCow(Flow):
+class MaCow(Flow, name='macow'):
     """
     Masked Convolutional Flow
     """
     def __init__(self, levels, num_steps, in_channels, kernel_size, factors, hidden_channels, s_channels=0,
-                 scale=True, prior_scale=True, inverse=False, bottom=True, coupling_type='conv', slices=None, heads=1, pos_enc=True, dropout=0.0):
+                 scale=True, prior_scale=True, inverse=False, bottom=True, coupling_type='conv', slices=None, heads=1, pos_enc=True, dropout=0.0,
+                 channels_last=False):
         super(MaCow, self).__init__(inverse)
+        # run the blocks on NHWC (channels_last) activations and conv weights, opt-in
+        self.channels_last = channels_last
         assert levels > 1, 'MaCow should have at least 2 levels.'
         assert len(kernel_size) == 2, 'kernel size should contain two numbers'
         assert levels == len(num_steps)
@@ -366,90 +372,157 @@ class MaCow(Flow):
                 blocks.append(macow_block)
                 in_channels = macow_block.z1_channels
         self.blocks = nn.ModuleList(blocks)
+        # block kinds resolved once for the forward/backward loops
+        self._is_internal = [isinstance(block, MaCowInternalBlock) for block in blocks]
+        self._needs_squeeze = [is_internal or isinstance(block, MaCowTopBlock) for is_internal, block in zip(self._is_internal, blocks)]
+        if channels_last:
+            self.set_channels_last()
+        # flat list of the leaf flows that need syncing (the Conv1x1Flows),
+        # so that sync() does not walk blocks, steps and glow steps each time
+        self._syncables = [module for module in self.modules()
+                           if hasattr(module, 'sync') and not any(hasattr(sub, 'sync') for sub in list(module.modules())[1:])]
+        # CUDA graphs captured by capture_graph, keyed by reverse and the graph_key of (input, s)
+        self._graphs = dict()
 
     def sync(self):
-        for block in self.blocks:
-            block.sync()
+        for module in self._syncables:
+            module.sync()
+
+    def set_channels_last(self, enabled=True):
+        self.channels_last = enabled
+        self.to(memory_format=torch.channels_last if enabled else torch.contiguous_format)
+
+    def _apply(self, fn, *args, **kwargs):
+        # the captured graphs point to the old parameter storage
+        self._graphs = dict()
+        return super(MaCow, self)._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, *args, **kwargs):
+        # load_state_dict(assign=True) replaces the parameters the graphs were captured with
+        if local_metadata.get('assign_to_params_buffers', False):
+            self._graphs = dict()
+        super(MaCow, self)._load_from_state_dict(state_dict, prefix, local_metadata, *args, **kwargs)
+
+    def _replicate_for_data_parallel(self):
+        replica = super(MaCow, self)._replicate_for_data_parallel()
+        replica._graphs = dict()
+        return replica
+
+    def capture_graph(self, input_shape, s_shape=None, reverse=False, warmup=3):
+        """
+        Capture the forward (backward if reverse) pass for fixed input shapes into a CUDA graph.
+        Later calls with the same shapes and with grad disabled replay the graph instead of launching
+        each kernel from Python. Parameters must stay in place: optimizer steps and load_state_dict
+        are fine, moving or casting the model and load_state_dict(assign=True) drop the graphs.
+        """
+        param = next(self.parameters())
+        static_in = param.new_zeros(input_shape)
+        static_s = None if s_shape is None else param.new_zeros(s_shape)
+        fn = self.backward if reverse else self.forward
+        captured = capture_cuda_graph(lambda input, s: fn(input, s=s), (static_in, static_s), warmup=warmup)
+        self._graphs[(reverse,) + graph_key(static_in, static_s)] = captured
+
+    def _replay(self, input, s, reverse):
+        if torch.is_grad_enabled() or not input.is_cuda:
+            return None
+        captured = self._graphs.get((reverse,) + graph_key(input, s))
+        if captured is None:
+            return None
+        return replay_cuda_graph(captured, (input, s))
+
+    def _format(self, x):
+        # squeeze2d/unsqueeze2d and cat return NCHW tensors, so inputs are converted at each block boundary
+        if x is None or not self.channels_last:
+            return x
+        return x.contiguous(memory_format=torch.channels_last)
 
-    # @overrides
     def forward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
-        logdet_accum = input.new_zeros(input.size(0))
+        if self._graphs:
+            replayed = self._replay(input, s, reverse=False)
+            if replayed is not None:
+                return replayed
+        logdets = []
         out = input
         outputs = []
-        for i, block in enumerate(self.blocks):
-            if isinstance(block, MaCowInternalBlock) or isinstance(block, MaCowTopBlock):
+        for block, is_internal, needs_squeeze in zip(self.blocks, self._is_internal, self._needs_squeeze):
+            if needs_squeeze:
                 if s is not None:
                     s = squeeze2d(s, factor=2)
                 out = squeeze2d(out, factor=2)
-            out, logdet = block.forward(out, s=s)
-            logdet_accum = logdet_accum + logdet
-            if isinstance(block, MaCowInternalBlock):
-                out1, out2 = split2d(out, block.z1_channels)
-                outputs.append(out2)
-                out = out1
+            out, logdet = block.forward(self._format(out), s=self._format(s))
+            logdets.append(logdet)
+            if is_internal:
+                z1_channels = block.z1_channels
+                outputs.append(out.narrow(1, z1_channels, out.size(1) - z1_channels))
+                out = out.narrow(1, 0, z1_channels)
 
         out = unsqueeze2d(out, factor=2)
         for _ in range(self.internals):
             out2 = outputs.pop()
-            out = unsqueeze2d(unsplit2d([out, out2]), factor=2)
+            out = unsqueeze2d(torch.cat([out, out2], dim=1), factor=2)
         assert len(outputs) == 0
-        return out, logdet_accum
+        return out, sum_logdets(logdets, input)
 
-    # @overrides
     def backward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self._graphs:
+            replayed = self._replay(input, s, reverse=True)
+            if replayed is not None:
+                return replayed
         outputs = []
-        if s is not None:
-            s = squeeze2d(s, factor=2)
-        out = squeeze2d(input, factor=2)
-        for block in self.blocks:
-            if isinstance(block, MaCowInternalBlock):
-                if s is not None:
-                    s = squeeze2d(s, factor=2)
-                out1, out2 = split2d(out, block.z1_channels)
-                outputs.append(out2)
-                out = squeeze2d(out1, factor=2)
+        # the conditional input of every level, squeezed once on the way down and reused on the way up
+        # (instead of unsqueezing it again after each block)
+        s_levels = []
+        for needs_squeeze in self._needs_squeeze:
+            if needs_squeeze and s is not None:
+                s = squeeze2d(s, factor=2)
+            s_levels.append(self._format(s))
 
-        logdet_accum = input.new_zeros(input.size(0))
-        for i, block in enumerate(reversed(self.blocks)):
-            if isinstance(block, MaCowInternalBlock):
+        out = squeeze2d(input, factor=2)
+        for block, is_internal in zip(self.blocks, self._is_internal):
+            if is_internal:
+                z1_channels = block.z1_channels
+                outputs.append(out.narrow(1, z1_channels, out.size(1) - z1_channels))
+                out = squeeze2d(out.narrow(1, 0, z1_channels), factor=2)
+
+        logdets = []
+        for block, is_internal, needs_squeeze, s in zip(reversed(self.blocks), reversed(self._is_internal),
+                                                        reversed(self._needs_squeeze), reversed(s_levels)):
+            if is_internal:
                 out2 = outputs.pop()
-                out = unsplit2d([out, out2])
-            out, logdet = block.backward(out, s=s)
-            logdet_accum = logdet_accum + logdet
-            if isinstance(block, MaCowInternalBlock) or isinstance(block, MaCowTopBlock):
-                if s is not None:
-                    s = unsqueeze2d(s, factor=2)
+                out = torch.cat([out, out2], dim=1)
+            out, logdet = block.backward(self._format(out), s=s)
+            logdets.append(logdet)
+            if needs_squeeze:
                 out = unsqueeze2d(out, factor=2)
         assert len(outputs) == 0
-        return out, logdet_accum
+        if self.channels_last:
+            # the output of the bottom block is still NHWC, callers expect a contiguous tensor
+            out = out.contiguous()
+        return out, sum_logdets(logdets, input)
 
-    # @overrides
     def init(self, data, s=None, init_scale=1.0) -> Tuple[torch.Tensor, torch.Tensor]:
-        logdet_accum = data.new_zeros(data.size(0))
+        logdets = []
         out = data
         outputs = []
-        for i, block in enumerate(self.blocks):
-            if isinstance(block, MaCowInternalBlock) or isinstance(block, MaCowTopBlock):
+        for block, is_internal, needs_squeeze in zip(self.blocks, self._is_internal, self._needs_squeeze):
+            if needs_squeeze:
                 if s is not None:
                     s = squeeze2d(s, factor=2)
                 out = squeeze2d(out, factor=2)
-            out, logdet = block.init(out, s=s, init_scale=init_scale)
-            logdet_accum = logdet_accum + logdet
-            if isinstance(block, MaCowInternalBlock):
-                out1, out2 = split2d(out, block.z1_channels)
-                outputs.append(out2)
-                out = out1
+            out, logdet = block.init(self._format(out), s=self._format(s), init_scale=init_scale)
+            logdets.append(logdet)
+            if is_internal:
+                z1_channels = block.z1_channels
+                outputs.append(out.narrow(1, z1_channels, out.size(1) - z1_channels))
+                out = out.narrow(1, 0, z1_channels)
 
         out = unsqueeze2d(out, factor=2)
         for _ in range(self.internals):
             out2 = outputs.pop()
-            out = unsqueeze2d(unsplit2d([out, out2]), factor=2)
+            out = unsqueeze2d(torch.cat([out, out2], dim=1), factor=2)
         assert len(outputs) == 0
-        return out, logdet_accum
+        return out, sum_logdets(logdets, data)
 
     @classmethod
     def from_params(cls, params: Dict) -> "MaCow":
         return MaCow(**params)
-
-
-MaCow.register('macow')
@@ -1,13 +1,14 @@
 __author__ = 'max'
 
-from overrides import overrides
 from typing import Tuple, Dict
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn.modules.utils import _pair
 
 from macow.flows.flow import Flow
+from macow.utils import affine_fwd, affine_bwd, affine_fwd_, affine_bwd_
 from macow.nnet.weight_norm import Conv2dWeightNorm, NIN2d, NIN4d
 from macow.nnet.attention import MultiHeadAttention2d
 
@@ -18,6 +19,8 @@ class NICEConvBlock(nn.Module):
         self.conv1 = Conv2dWeightNorm(in_channels + s_channels, hidden_channels, kernel_size=3, dilation=dilation, padding=dilation, bias=True)
         self.conv2 = Conv2dWeightNorm(hidden_channels, hidden_channels, kernel_size=1, bias=True)
         self.conv3 = Conv2dWeightNorm(hidden_channels, out_channels, kernel_size=3, dilation=dilation, padding=dilation, bias=True)
+        # the bias adds run inside the convs and the ELUs in place: there is no elementwise chain left to fuse,
+        # and conv1 -> ELU -> conv2 cannot be folded into a single (separable) conv because of the nonlinearity
         self.activation = nn.ELU(inplace=True)
 
     def init(self, x, s=None, init_scale=1.0):
@@ -32,11 +35,21 @@ class NICEConvBlock(nn.Module):
 
         return out
 
+    def conv1_split(self, x, s):
+        # conv1(cat([x, s])) computed as conv(x, W[:, :Cx]) + conv(s, W[:, Cx:]) on slices of the
+        # effective kernel, so the concatenated input is not materialized on every call. The s term
+        # cannot be shared: every block has its own kernel, and s changes with every call.
+        conv = self.conv1.conv
+        weight = self.conv1.weight()
+        x_channels = x.size(1)
+        out = F.conv2d(x, weight[:, :x_channels], conv.bias, conv.stride, conv.padding, conv.dilation, conv.groups)
+        return out.add_(F.conv2d(s, weight[:, x_channels:], None, conv.stride, conv.padding, conv.dilation, conv.groups))
+
     def forward(self, x, s=None):
         if s is not None:
-            x = torch.cat([x, s], dim=1)
-
-        out = self.activation(self.conv1(x))
+            out = self.activation(self.conv1_split(x, s))
+        else:
+            out = self.activation(self.conv1(x))
 
         out = self.activation(self.conv2(out))
 
@@ -153,7 +166,7 @@ class NICESelfAttnBlock(nn.Module):
         return x
 
 
-class NICE(Flow):
+class NICE(Flow, name='nice'):
     def __init__(self, in_channels, hidden_channels=None, s_channels=None, scale=True, inverse=False, factor=2,
                  type='conv', slice=None, heads=1, pos_enc=True, dropout=0.0):
         super(NICE, self).__init__(inverse)
@@ -177,25 +190,6 @@ class NICE(Flow):
             self.net = NICESelfAttnBlock(in_channels, out_channels, hidden_channels, s_channels,
                                          slice=slice, heads=heads, pos_enc=pos_enc, dropout=dropout)
 
-    def calc_mu_and_scale(self, z1: torch.Tensor, s=None):
-        mu = self.net(z1, s=s)
-        scale = None
-        if self.scale:
-            mu, log_scale = mu.chunk(2, dim=1)
-            # scale = log_scale.add_(2.).sigmoid_()
-            scale = log_scale.add(2.).sigmoid_()
-        return mu, scale
-
-    def init_net(self, z1: torch.Tensor, s=None, init_scale=1.0):
-        mu = self.net.init(z1, s=s, init_scale=init_scale)
-        scale = None
-        if self.scale:
-            mu, log_scale = mu.chunk(2, dim=1)
-            # scale = log_scale.add_(2.).sigmoid_()
-            scale = log_scale.add(2.).sigmoid_()
-        return mu, scale
-
-    # @overrides
     def forward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Args:
@@ -207,19 +201,36 @@ class NICE(Flow):
             out: [batch, in_channels, H, W], the output of the flow
             logdet: [batch], the log determinant of :math:`\partial output / \partial input`
         """
+        if not torch.is_grad_enabled():
+            return self._coupling_inplace(input, s, reverse=False)
+        z1, z2, logdet = self.forward_split(input, s=s)
+        return self.forward_merged(z1, z2), logdet
+
+    def forward_split(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        forward without the final concatenation, for consumers that split the output again
+        at z1_channels: forward(input) == (forward_merged(z1, z2), logdet).
+
+        Returns: z1: Tensor, z2: Tensor, logdet: Tensor
+            z1: [batch, z1_channels, H, W], the untouched half (a view of input)
+            z2: [batch, in_channels - z1_channels, H, W], the transformed half
+            logdet: [batch] or None (see Flow)
+        """
         # [batch, in_channels, H, W]
         z1 = input[:, :self.z1_channels]
         z2 = input[:, self.z1_channels:]
-        mu, scale = self.calc_mu_and_scale(z1, s)
+        raw = self.net(z1, s=s)
         if self.scale:
-            z2 = z2.mul(scale)
-            logdet = scale.log().view(z1.size(0), -1).sum(dim=1)
+            z2, logdet = affine_fwd(raw, z2)
         else:
-            logdet = z1.new_zeros(z1.size(0))
-        z2 = z2 + mu
-        return torch.cat([z1, z2], dim=1), logdet
+            z2 = z2 + raw
+            logdet = None
+        return z1, z2, logdet
+
+    @staticmethod
+    def forward_merged(z1: torch.Tensor, z2: torch.Tensor) -> torch.Tensor:
+        return torch.cat([z1, z2], dim=1)
 
-    # @overrides
     def backward(self, input: torch.Tensor, s=None) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Args:
@@ -231,40 +242,49 @@ class NICE(Flow):
             out: [batch, in_channels, H, W], the output of the flow
             logdet: [batch], the log determinant of :math:`\partial output / \partial input`
         """
+        if not torch.is_grad_enabled():
+            return self._coupling_inplace(input, s, reverse=True)
         z1 = input[:, :self.z1_channels]
         z2 = input[:, self.z1_channels:]
-        mu, scale = self.calc_mu_and_scale(z1, s)
-        z2 = z2 - mu
+        raw = self.net(z1, s=s)
         if self.scale:
-            z2 = z2.div(scale + 1e-12)
-            logdet = scale.log().view(z1.size(0), -1).sum(dim=1) * -1.0
+            z2, logdet = affine_bwd(raw, z2)
         else:
-            logdet = z1.new_zeros(z1.size(0))
-
+            z2 = z2 - raw
+            logdet = None
         return torch.cat([z1, z2], dim=1), logdet
 
-    # @overrides
+    def _coupling_inplace(self, input: torch.Tensor, s, reverse) -> Tuple[torch.Tensor, torch.Tensor]:
+        # without autograd there is nothing to keep alive: copy the input once and transform
+        # its z2 part in place, instead of allocating z2 and concatenating [z1, z2]
+        out = input.clone()
+        z2 = out[:, self.z1_channels:]
+        raw = self.net(input[:, :self.z1_channels], s=s)
+        if self.scale:
+            logdet = affine_bwd_(raw, z2) if reverse else affine_fwd_(raw, z2)
+        else:
+            if reverse:
+                z2.sub_(raw)
+            else:
+                z2.add_(raw)
+            logdet = None
+        return out, logdet
+
     def init(self, data: torch.Tensor, s=None, init_scale=1.0) -> Tuple[torch.Tensor, torch.Tensor]:
         # [batch, in_channels, H, W]
         z1 = data[:, :self.z1_channels]
         z2 = data[:, self.z1_channels:]
-        mu, scale = self.init_net(z1, s=s, init_scale=init_scale)
+        raw = self.net.init(z1, s=s, init_scale=init_scale)
         if self.scale:
-            z2 = z2.mul(scale)
-            logdet = scale.log().view(z1.size(0), -1).sum(dim=1)
+            z2, logdet = affine_fwd(raw, z2)
         else:
-            logdet = z1.new_zeros(z1.size(0))
-        z2 = z2 + mu
-
+            z2 = z2 + raw
+            logdet = None
         return torch.cat([z1, z2], dim=1), logdet
 
-    # @overrides
     def extra_repr(self):
         return 'inverse={}, in_channels={}, scale={}'.format(self.inverse, self.in_channels, self.scale)
 
     @classmethod
     def from_params(cls, params: Dict) -> "NICE":
         return NICE(**params)
-
-
-NICE.register('nice')
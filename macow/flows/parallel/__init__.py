@@ -1,3 +1,4 @@
 __author__ = 'max'
 
 from macow.flows.parallel.data_parallel import DataParallelFlow
+from macow.flows.parallel.distributed import DistributedDataParallelFlow, init_distributed
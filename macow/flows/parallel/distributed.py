@@ -0,0 +1,74 @@
+__author__ = 'max'
+
+import os
+from typing import Tuple
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+from macow.flows.flow import Flow
+
+
+def init_distributed(backend='nccl') -> int:
+    """
+    Set up the process group for one process per GPU. Call it in every process before building
+    a model with use_ddp=True, passing the returned local rank as its GPU id. Starting the processes
+    (with LOCAL_RANK set, as torchrun does) and sharding the data across ranks (e.g. with a
+    DistributedSampler) is up to the caller; the experiment scripts do neither.
+
+    Returns: int
+        the local rank, i.e. the GPU used by this process
+    """
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    torch.cuda.set_device(local_rank)
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    return local_rank
+
+
+class _FlowPass(nn.Module):
+    """
+    DistributedDataParallel hooks into forward(), route both directions of the flow through it.
+    """
+    def __init__(self, flow: Flow):
+        super(_FlowPass, self).__init__()
+        self.flow = flow
+
+    def forward(self, *inputs, backward=False, **kwargs):
+        return self.flow.backward(*inputs, **kwargs) if backward else self.flow.forward(*inputs, **kwargs)
+
+
+class DistributedDataParallelFlow(Flow):
+    """
+    Implements distributed data parallelism (one process per GPU) at the flow level.
+    The process group has to be initialized before (see init_distributed).
+    """
+    def __init__(self, flow: Flow, device_id, bucket_cap_mb=50):
+        super(DistributedDataParallelFlow, self).__init__(flow.inverse)
+        self.flow = flow.cuda(device_id)
+        # not registered as submodule: it shares the parameters of self.flow,
+        # and the state dict keeps the same keys as with DataParallelFlow
+        ddp = DistributedDataParallel(_FlowPass(self.flow), device_ids=[device_id], output_device=device_id,
+                                      broadcast_buffers=False, find_unused_parameters=False, bucket_cap_mb=bucket_cap_mb)
+        object.__setattr__(self, 'ddp', ddp)
+
+    def no_sync(self):
+        """
+        Context manager in which gradients are accumulated locally without all-reduce.
+        """
+        return self.ddp.no_sync()
+
+    def forward(self, *inputs, **kwargs) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.ddp(*inputs, backward=False, **kwargs)
+
+    def backward(self, *inputs, **kwargs) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.ddp(*inputs, backward=True, **kwargs)
+
+    def init(self, *input, **kwargs) -> Tuple[torch.Tensor, torch.Tensor]:
+        out = self.flow.init(*input, **kwargs)
+        # the data-dependent initialization differs between ranks, start all of them from rank 0
+        with torch.no_grad():
+            for tensor in self.flow.state_dict().values():
+                dist.broadcast(tensor, 0)
+        return out
@@ -3,47 +3,155 @@ __author__ = 'max'
 import os
 import json
 import math
+from contextlib import ExitStack, nullcontext
 from typing import Dict, Tuple
 import torch
 import torch.nn as nn
-from overrides import overrides
 
 from macow.flows.flow import Flow
-from macow.flows.parallel import DataParallelFlow
+from macow.flows.parallel import DataParallelFlow, DistributedDataParallelFlow
 from macow.flows.dequant import DeQuantFlow
+from macow.utils import graph_key, capture_cuda_graph, replay_cuda_graph
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# log(2 * pi), the per-dimension constant of the standard normal log-density. Kept a Python float
+# rather than a buffer: it goes into sub_ as a scalar argument (no extra kernel, no device transfer),
+# torch.compile specializes on it as a constant, and the state dict of existing checkpoints is unchanged.
+_LOG_2PI = math.log(2.0 * math.pi)
+
+# torch.compile'd functions, compiled on first use and shared by all models
+_compiled_fns = dict()
+
+
+def _compiled(fn, **kwargs):
+    # fn is a plain function (methods are passed unbound and called with the model as first argument):
+    # a compiled bound method stored on the model would make every model a reference cycle
+    compiled = _compiled_fns.get(fn)
+    if compiled is None:
+        compiled = torch.compile(fn, **kwargs)
+        _compiled_fns[fn] = compiled
+    return compiled
+
+
+def _load_config(model_path) -> Dict:
+    with open(os.path.join(model_path, 'config.json'), 'rb') as f:
+        data = f.read()
+    # orjson is optional, json.loads accepts the raw bytes as well
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _tile_samples(x, nsamples) -> torch.Tensor:
+    batch = x.size(0)
+    # [batch * nsamples, channels, H, W]; expand is a view, reshape makes the only copy
+    return x.unsqueeze(1).expand(batch, nsamples, *x.size()[1:]).reshape(batch * nsamples, *x.size()[1:])
+
+
+def _log_posteriors(epsilon, logdet) -> torch.Tensor:
+    # [batch * nsamples, channels, H, W] -> [batch * nsamples], same in-place chain as in _log_probability
+    log_posteriors = torch.einsum('b...,b...->b', epsilon, epsilon)
+    return log_posteriors.mul_(-0.5).sub_(logdet).sub_(0.5 * _LOG_2PI * epsilon[0].numel())
 
 
 class FlowGenModel(nn.Module):
     """
     Flow-based Generative model
     """
-    def __init__(self, flow: Flow, ngpu=1, gpu_id=0):
+    def __init__(self, flow: Flow, ngpu=1, gpu_id=0, use_ddp=False, compile=False, amp_dtype=None, use_channels_last=False):
         super(FlowGenModel, self).__init__()
+        # NHWC layout for the images and the conv weights (tensor-core cuDNN kernels), see to_device.
+        # It also switches on the channels_last mode of the flows that have one (MaCow, DeQuantFlow).
+        self.use_channels_last = use_channels_last
+        # run the flows under autocast with this dtype (e.g. 'bfloat16'), None disables it. Outputs and
+        # logdets are returned in fp32; the inverse passes (decode) lose precision in low precision.
+        self.amp_dtype = getattr(torch, amp_dtype) if isinstance(amp_dtype, str) else amp_dtype
         assert flow.inverse, 'flow based generative should have inverse mode'
+        flow.finalize()
+        self._set_channels_last(flow)
         self.flow = flow
         assert ngpu > 0, 'the number of GPUs should be positive.'
         self.ngpu = ngpu
+        self.use_ddp = use_ddp
         self.device = None
-        if ngpu > 1:
-            device_ids = list(range(ngpu))
-            device_ids[gpu_id] = 0
-            device_ids[0] = gpu_id
+        if use_ddp:
+            # one process per GPU (see macow.flows.parallel.init_distributed), gpu_id is the local rank
+            self.device = torch.device('cuda:{}'.format(gpu_id))
+            self.flow = DistributedDataParallelFlow(self.flow, device_id=gpu_id)
+        elif ngpu > 1:
+            # the flow lives on gpu_id, which has to come first; gather the outputs there as well
+            device_ids = [gpu_id] + [i for i in range(ngpu) if i != gpu_id]
             self.device = torch.device('cuda:{}'.format(gpu_id))
-            self.flow = DataParallelFlow(self.flow, device_ids=device_ids, output_device=0)
+            self.flow = DataParallelFlow(self.flow, device_ids=device_ids, output_device=gpu_id)
+        # log_probability (encode + the Gaussian reduction) compiled with inductor and CUDA graphs, opt-in
+        self.use_compile = compile and torch.cuda.is_available()
+        # CUDA graphs of the no-grad log_probability captured by capture_graph, keyed by graph_key of the input
+        self._graphs = dict()
+        # uniform dequantization noise and zero log-posteriors, reused while the shape stays the same
+        self._unif_buf = None
+        self._zeros_buf = None
 
     def sync(self):
-        flow = self.flow.flow if isinstance(self.flow, DataParallelFlow) else self.flow
+        flow = self.flow.flow if isinstance(self.flow, (DataParallelFlow, DistributedDataParallelFlow)) else self.flow
         flow.sync()
 
     def to_device(self, device):
         if self.device is None:
-            return self.to(device)
+            self.to(device)
         else:
-            return self.to(self.device)
+            self._place(self.flow, self.device)
+        return self._channels_last()
+
+    def _channels_last(self):
+        if self.use_channels_last:
+            # only 4D parameters (conv weights) change layout, in place of the old ones
+            self.to(memory_format=torch.channels_last)
+        return self
+
+    def _set_channels_last(self, flow):
+        if self.use_channels_last and hasattr(flow, 'set_channels_last'):
+            flow.set_channels_last()
+
+    def _memory_format(self, x) -> torch.Tensor:
+        if self.use_channels_last and x.dim() == 4:
+            return x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def _place(self, flow, device):
+        # move a wrapped flow directly; the DDP wrapper already put its flow on the GPU at construction
+        if not isinstance(flow, DistributedDataParallelFlow):
+            self._graphs = dict()
+            flow.to(device)
+
+    def autocast(self, input: torch.Tensor):
+        # a nullcontext without amp_dtype, so that an autocast of the caller stays in effect
+        if self.amp_dtype is None:
+            return nullcontext()
+        return torch.autocast(input.device.type, dtype=self.amp_dtype)
+
+    def no_sync(self, enabled=True):
+        """
+        Context manager skipping the gradient all-reduce of the DDP-wrapped flows, for all but the last
+        micro-batch of a gradient accumulation. No-op without DDP or if not enabled.
+        """
+        stack = ExitStack()
+        if enabled:
+            for flow in self.children():
+                if isinstance(flow, DistributedDataParallelFlow):
+                    stack.enter_context(flow.no_sync())
+        return stack
 
     def dequantize(self, x, nsamples=1) -> Tuple[torch.Tensor, torch.Tensor]:
         # [batch, nsamples, channels, H, W]
-        return x.new_empty(x.size(0), nsamples, *x.size()[1:]).uniform_(), x.new_zeros(x.size(0), nsamples)
+        shape = (x.size(0), nsamples) + x.size()[1:]
+        buf = self._unif_buf
+        if buf is None or buf.size() != shape or buf.device != x.device or buf.dtype != x.dtype:
+            self._unif_buf = x.new_empty(shape)
+            self._zeros_buf = x.new_zeros(x.size(0), nsamples)
+        # the noise is redrawn in place by the next call; the zeros are shared and must not be modified
+        return self._unif_buf.uniform_(), self._zeros_buf
 
     def encode(self, x) -> Tuple[torch.Tensor, torch.Tensor]:
         """
@@ -58,8 +166,10 @@ class FlowGenModel(nn.Module):
             Then the density :math:`\log(p(x)) = \log(p(z)) + logdet`
             eps: eps for multi-scale architecture.
         """
-        z, logdet = self.flow.bwdpass(x)
-        return z, logdet
+        x = self._memory_format(x)
+        with self.autocast(x):
+            z, logdet = self.flow.bwdpass(x)
+        return z.float(), logdet.float()
 
     def decode(self, z) -> Tuple[torch.Tensor, torch.Tensor]:
         """
@@ -73,10 +183,13 @@ class FlowGenModel(nn.Module):
             logdet, the log determinant of :math:`\partial z / \partial x`
             Then the density :math:`\log(p(x)) = \log(p(z)) + logdet`
         """
-        x, logdet = self.flow.fwdpass(z)
-        return x, logdet
+        z = self._memory_format(z)
+        with self.autocast(z):
+            x, logdet = self.flow.fwdpass(z)
+        return x.float(), logdet.float()
 
     def init(self, data, init_scale=1.0) -> Tuple[torch.Tensor, torch.Tensor]:
+        data = self._memory_format(data)
         return self.flow.bwdpass(data, init=True, init_scale=init_scale)
 
     def log_probability(self, x) -> torch.Tensor:
@@ -90,13 +203,54 @@ class FlowGenModel(nn.Module):
             Tensor
             The tensor of the posterior probabilities of x shape = [batch]
         """
+        if self._graphs:
+            replayed = self._replay(x)
+            if replayed is not None:
+                return replayed
+        if self.use_compile:
+            return _compiled(type(self)._log_probability, mode='reduce-overhead', fullgraph=False)(self, x)
+        return self._log_probability(x)
+
+    def capture_graph(self, input_shape, warmup=3):
+        """
+        Capture log_probability for a fixed input shape into a CUDA graph. Later calls with the same
+        shape and with grad disabled replay the graph instead of launching each kernel from Python.
+        Parameters must stay in place: optimizer steps and load_state_dict are fine, moving or casting
+        the model and load_state_dict(assign=True) drop the graphs.
+        """
+        static_in = next(self.parameters()).new_zeros(input_shape)
+        # the eager function: the compiled one (compile=True) is CUDA graphed by inductor already and
+        # cannot be captured into another graph
+        captured = capture_cuda_graph(lambda x: (self._log_probability(x),), (static_in,), warmup=warmup)
+        self._graphs[graph_key(static_in)] = captured
+
+    def _replay(self, x):
+        if torch.is_grad_enabled() or not x.is_cuda:
+            return None
+        captured = self._graphs.get(graph_key(x))
+        if captured is None:
+            return None
+        return replay_cuda_graph(captured, (x,))[0]
+
+    def _apply(self, fn, *args, **kwargs):
+        # the captured graphs point to the old parameter storage
+        self._graphs = dict()
+        return super(FlowGenModel, self)._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, *args, **kwargs):
+        # load_state_dict(assign=True) replaces the parameters the graphs were captured with
+        if local_metadata.get('assign_to_params_buffers', False):
+            self._graphs = dict()
+        super(FlowGenModel, self)._load_from_state_dict(state_dict, prefix, local_metadata, *args, **kwargs)
+
+    def _log_probability(self, x) -> torch.Tensor:
         # [batch, x_shape]
         z, logdet = self.encode(x)
-        # [batch, x_shape] --> [batch, numels]
-        z = z.view(z.size(0), -1)
-        # [batch]
-        log_probs = z.mul(z).sum(dim=1) + math.log(math.pi * 2.) * z.size(1)
-        return log_probs.mul(-0.5) + logdet
+        # [batch] squared norms over all non-batch dims, without flattening (a copy for channels last)
+        # or materializing z * z; einsum saves only z for backward, so the rest of the chain can run
+        # in place on its output
+        log_probs = torch.einsum('b...,b...->b', z, z)
+        return log_probs.mul_(-0.5).add_(logdet).sub_(0.5 * _LOG_2PI * z[0].numel())
 
     @classmethod
     def from_params(cls, params: Dict) -> "FlowGenModel":
@@ -104,59 +258,95 @@ class FlowGenModel(nn.Module):
         flow = Flow.by_name(flow_params.pop('type')).from_params(flow_params)
         return FlowGenModel(flow, **params)
 
+    @staticmethod
+    def _load_ckpt(path) -> Dict:
+        # weights_only: plain tensors, no arbitrary unpickling
+        try:
+            # memory-mapped, the tensors are assigned to the model instead of copied
+            return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+        except RuntimeError:
+            # legacy (non-zipfile) checkpoints cannot be memory-mapped
+            return torch.load(path, map_location='cpu', weights_only=True)
+
     @classmethod
     def load(cls, model_path, device) -> "FlowGenModel":
-        params = json.load(open(os.path.join(model_path, 'config.json'), 'r'))
-        model_name = os.path.join(model_path, 'model.pt')
-        fgen = FlowGenModel.from_params(params)
-        fgen.load_state_dict(torch.load(model_name, map_location=device))
+        """
+        Build the model from model_path/config.json and load model_path/model.pt
+        (shared by the subclasses through cls.from_params).
+        """
+        params = _load_config(model_path)
+        fgen = cls.from_params(params)
+        state_dict = cls._load_ckpt(os.path.join(model_path, 'model.pt'))
+        # DDP keeps references to the parameters it was built with, copy into those
+        fgen.load_state_dict(state_dict, assign=not fgen.use_ddp)
         return fgen.to(device)
 
 
 class VDeQuantFlowGenModel(FlowGenModel):
-    def __init__(self, flow: Flow, dequant_flow: Flow, ngpu=1, gpu_ids=(0, 0)):
+    def __init__(self, flow: Flow, dequant_flow: Flow, ngpu=1, gpu_ids=(0, 0), use_ddp=False, compile=False, amp_dtype=None,
+                 use_channels_last=False):
         flow_gpu_id, dequant_gpu_id = gpu_ids
-        super(VDeQuantFlowGenModel, self).__init__(flow, ngpu, flow_gpu_id)
+        super(VDeQuantFlowGenModel, self).__init__(flow, ngpu, flow_gpu_id, use_ddp=use_ddp, compile=compile, amp_dtype=amp_dtype,
+                                                   use_channels_last=use_channels_last)
         assert not dequant_flow.inverse, 'dequantization flow should NOT have inverse mode'
+        dequant_flow.finalize()
+        self._set_channels_last(dequant_flow)
         self.dequant_flow = dequant_flow
         self.dequant_device = None
-        if ngpu > 1:
-            device_ids = list(range(ngpu))
-            device_ids[dequant_gpu_id] = 0
-            device_ids[0] = dequant_gpu_id
+        # epsilon is drawn in place into this buffer while batch shape and device stay the same
+        self._eps_buf = None
+        if use_ddp:
             self.dequant_device = torch.device('cuda:{}'.format(dequant_gpu_id))
-            self.dequant_flow = DataParallelFlow(self.dequant_flow, device_ids=device_ids, output_device=0)
+            self.dequant_flow = DistributedDataParallelFlow(self.dequant_flow, device_id=dequant_gpu_id)
+        elif ngpu > 1:
+            device_ids = [dequant_gpu_id] + [i for i in range(ngpu) if i != dequant_gpu_id]
+            self.dequant_device = torch.device('cuda:{}'.format(dequant_gpu_id))
+            self.dequant_flow = DataParallelFlow(self.dequant_flow, device_ids=device_ids, output_device=dequant_gpu_id)
 
-    # @overrides
     def to_device(self, device):
         if self.device is None:
             assert self.dequant_device is None
-            return self.to(device)
+            self.to(device)
         else:
-            self.flow = self.flow.to(self.device)
-            self.dequant_flow = self.dequant_flow.to(self.dequant_device)
-            return self
+            self._place(self.flow, self.device)
+            self._place(self.dequant_flow, self.dequant_device)
+        return self._channels_last()
 
-    # @overrides
     def dequantize(self, x, nsamples=1) -> Tuple[torch.Tensor, torch.Tensor]:
         batch = x.size(0)
         # [batch * nsamples, channels, H, W]
-        epsilon = torch.randn(batch * nsamples, *x.size()[1:], device=x.device)
+        epsilon = self._normal(batch * nsamples, x)
+        # the elementwise parts around the dequantization flow, fused by inductor with compile.
+        # _tile_samples only runs for nsamples > 1, so nsamples = 1 never goes through its guards.
+        tile, log_posteriors = _tile_samples, _log_posteriors
+        if self.use_compile:
+            tile, log_posteriors = _compiled(_tile_samples), _compiled(_log_posteriors)
         if nsamples > 1:
-            x = x.unsqueeze(1) + x.new_zeros(batch, nsamples, *x.size()[1:])
-            x = x.view(epsilon.size())
-        u, logdet = self.dequant_flow.fwdpass(epsilon, x)
-        # [batch * nsamples, channels, H, W]
-        epsilon = epsilon.view(epsilon.size(0), -1)
-        # [batch * nsamples]
-        log_posteriors = epsilon.mul(epsilon).sum(dim=1) + math.log(math.pi * 2.) * epsilon.size(1)
-        log_posteriors = log_posteriors.mul(-0.5) - logdet
+            x = tile(x, nsamples)
+        x = self._memory_format(x)
+        with self.autocast(x):
+            u, logdet = self.dequant_flow.fwdpass(epsilon, x)
+        u, logdet = u.float(), logdet.float()
+        if self.use_compile:
+            # batch * nsamples changes with nsamples, one graph for all of them
+            torch._dynamo.mark_dynamic(epsilon, 0)
+            torch._dynamo.mark_dynamic(logdet, 0)
+        log_posteriors = log_posteriors(epsilon, logdet)
         return u.view(batch, nsamples, *x.size()[1:]), log_posteriors.view(batch, nsamples)
 
-    # @overrides
+    def _normal(self, n, x) -> torch.Tensor:
+        # standard normal [n, channels, H, W]. The buffer is refilled by the next call, so epsilon must not
+        # be kept across calls (autograd raises if a graph still holding it is run after the refill).
+        buf = self._eps_buf
+        if buf is None or buf.size(0) != n or buf.size()[1:] != x.size()[1:] or buf.device != x.device:
+            buf = self._memory_format(torch.empty(n, *x.size()[1:], device=x.device))
+            self._eps_buf = buf
+        return buf.normal_()
+
     def init(self, data, init_scale=1.0) -> Tuple[torch.Tensor, torch.Tensor]:
         # [batch, channels, H, W]
-        epsilon = torch.randn(data.size(), device=data.device)
+        data = self._memory_format(data)
+        epsilon = self._normal(data.size(0), data)
         self.dequant_flow.fwdpass(epsilon, data, init=True, init_scale=init_scale)
         return self.flow.bwdpass(data, init=True, init_scale=init_scale)
 
@@ -167,11 +357,3 @@ class VDeQuantFlowGenModel(FlowGenModel):
         dequant_params = params.pop('dequant')
         dequant_flow = DeQuantFlow.from_params(dequant_params)
         return VDeQuantFlowGenModel(flow, dequant_flow, **params)
-
-    @classmethod
-    def load(cls, model_path, device) -> "VDeQuantFlowGenModel":
-        params = json.load(open(os.path.join(model_path, 'config.json'), 'r'))
-        model_name = os.path.join(model_path, 'model.pt')
-        fgen = VDeQuantFlowGenModel.from_params(params)
-        fgen.load_state_dict(torch.load(model_name, map_location=device))
-        return fgen.to(device)
@@ -7,6 +7,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.modules.utils import _pair
 from torch.nn import Parameter
+from torch.nn.utils.weight_norm import WeightNorm
 
 from macow.utils import norm
 
@@ -195,6 +196,15 @@ class Conv2dWeightNorm(nn.Module):
     def forward(self, input):
         return self.conv(input)
 
+    def weight(self) -> torch.Tensor:
+        """
+        The effective kernel, computed by the weight norm hook of self.conv exactly as in forward.
+        """
+        for hook in self.conv._forward_pre_hooks.values():
+            if isinstance(hook, WeightNorm):
+                return hook.compute_weight(self.conv)
+        return self.conv.weight
+
     # @overrides
     def extra_repr(self) -> str:
         return self.conv.extra_repr()
@@ -1,8 +1,8 @@
 __author__ = 'max'
 
+from math import inf
 from typing import Tuple, List
 import torch
-from torch._six import inf
 
 
 def norm(p: torch.Tensor, dim: int):
@@ -19,6 +19,10 @@ def norm(p: torch.Tensor, dim: int):
         return norm(p.transpose(0, dim), 0).transpose(0, dim)
 
 
+# squeeze2d/unsqueeze2d are NOT pixel_unshuffle/pixel_shuffle: those order the output channels as
+# [channels, factor, factor], here it is [factor, factor, channels]. The order fixes which channels the
+# splits factor out and the layout of the trained actnorm/conv1x1 parameters, so it cannot change
+# without breaking checkpoints; the view + permute + contiguous below is already a single copy.
 def squeeze2d(x, factor=2) -> torch.Tensor:
     assert factor >= 1
     if factor == 1:
@@ -65,8 +69,7 @@ def unsqueeze2d(x: torch.Tensor, factor=2) -> torch.Tensor:
 
 
 def split2d(x: torch.Tensor, z1_channels) -> Tuple[torch.Tensor, torch.Tensor]:
-    z1 = x[:, :z1_channels]
-    z2 = x[:, z1_channels:]
+    z1, z2 = x.tensor_split([z1_channels], dim=1)
     return z1, z2
 
 
@@ -75,6 +78,106 @@ def unsplit2d(xs: List[torch.Tensor]) -> torch.Tensor:
     return torch.cat(xs, dim=1)
 
 
+# Affine transform of the coupling layers (NICE, MCF). raw is the output of the coupling net,
+# [mu, log_scale] along channels, with scale = sigmoid(log_scale + 2).
+# Scripted so that the elementwise chain is fused; narrow gives views instead of chunk copies.
+# The inverse multiplies by the reciprocal of the scale rather than dividing; the logdet is still
+# taken from log(scale) so that forward and inverse logdets cancel exactly.
+# The coupling nets may run under autocast (bf16/fp16); the transform and its Jacobian are always
+# computed in fp32 (the casts are no-ops for fp32 inputs).
+@torch.jit.script
+def affine_fwd(raw: torch.Tensor, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    raw = raw.float()
+    x = x.float()
+    channels = x.size(1)
+    mu = raw.narrow(1, 0, channels)
+    scale = torch.sigmoid(raw.narrow(1, channels, channels) + 2.)
+    out = x * scale + mu
+    logdet = torch.log(scale).flatten(1).sum(dim=1)
+    return out, logdet
+
+
+@torch.jit.script
+def affine_inv(raw: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+    raw = raw.float()
+    x = x.float()
+    channels = x.size(1)
+    mu = raw.narrow(1, 0, channels)
+    scale = torch.sigmoid(raw.narrow(1, channels, channels) + 2.)
+    return (x - mu) * torch.reciprocal(scale + 1e-12)
+
+
+@torch.jit.script
+def affine_bwd(raw: torch.Tensor, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    raw = raw.float()
+    x = x.float()
+    channels = x.size(1)
+    mu = raw.narrow(1, 0, channels)
+    scale = torch.sigmoid(raw.narrow(1, channels, channels) + 2.)
+    out = (x - mu) * torch.reciprocal(scale + 1e-12)
+    logdet = torch.log(scale).flatten(1).sum(dim=1) * -1.0
+    return out, logdet
+
+
+# In-place variants for the no-grad paths: x (a view into a fresh output tensor) is overwritten
+# with the transformed values and only the logdet is returned.
+@torch.jit.script
+def affine_fwd_(raw: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+    raw = raw.float()
+    channels = x.size(1)
+    mu = raw.narrow(1, 0, channels)
+    scale = torch.sigmoid(raw.narrow(1, channels, channels) + 2.)
+    x.mul_(scale).add_(mu)
+    return torch.log(scale).flatten(1).sum(dim=1)
+
+
+@torch.jit.script
+def affine_bwd_(raw: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+    raw = raw.float()
+    channels = x.size(1)
+    mu = raw.narrow(1, 0, channels)
+    scale = torch.sigmoid(raw.narrow(1, channels, channels) + 2.)
+    x.sub_(mu).mul_(torch.reciprocal(scale + 1e-12))
+    return torch.log(scale).flatten(1).sum(dim=1) * -1.0
+
+
+def graph_key(*inputs):
+    # shapes, dtypes and devices of the graph inputs (None for absent ones): copying into the
+    # static inputs would silently cast or move a mismatched input
+    return tuple(None if x is None else (tuple(x.size()), x.dtype, x.device) for x in inputs)
+
+
+def capture_cuda_graph(fn, static_inputs, warmup=3):
+    """
+    Capture fn(*static_inputs), which returns a tuple of tensors, with grad disabled into a CUDA graph.
+    Returns the (graph, static_inputs, static_outputs) taken by replay_cuda_graph.
+    """
+    device = next(x for x in static_inputs if x is not None).device
+    with torch.no_grad():
+        # warm up on a side stream, as required before capture
+        stream = torch.cuda.Stream(device)
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            for _ in range(warmup):
+                fn(*static_inputs)
+        torch.cuda.current_stream(device).wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_outputs = fn(*static_inputs)
+    return graph, static_inputs, static_outputs
+
+
+def replay_cuda_graph(captured, inputs) -> Tuple[torch.Tensor, ...]:
+    graph, static_inputs, static_outputs = captured
+    for static, x in zip(static_inputs, inputs):
+        if static is not None:
+            static.copy_(x)
+    graph.replay()
+    # the static outputs are overwritten by the next replay
+    return tuple(out.clone() for out in static_outputs)
+
+
 def exponentialMovingAverage(original, shadow, decay_rate, init=False):
     params = dict()
     for name, param in shadow.named_parameters():
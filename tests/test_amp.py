@@ -0,0 +1,61 @@
+__author__ = 'max'
+
+import torch
+
+from macow.models import VDeQuantFlowGenModel
+from macow.nnet.weight_norm import Conv2dWeightNorm
+
+
+def build(amp_dtype):
+    torch.manual_seed(0)
+    params = {
+        "flow": {"type": "macow", "levels": 3, "num_steps": [1, [1], 1], "factors": [2],
+                 "in_channels": 3, "kernel_size": [2, 3], "scale": True,
+                 "hidden_channels": [8, 16, 16], "bottom": True, "coupling_type": "conv", "inverse": True},
+        "dequant": {"levels": 2, "num_steps": [1, 1], "factors": [], "in_channels": 3, "kernel_size": [2, 3],
+                    "scale": True, "hidden_channels": [8, 16], "s_channels": 4, "bottom": True},
+        "ngpu": 1, "gpu_ids": [0, 0], "amp_dtype": amp_dtype}
+    fgen = VDeQuantFlowGenModel.from_params(params)
+    x = torch.rand(4, 3, 8, 8) * 2 - 1
+    fgen.init(x, init_scale=1.0)
+    fgen.sync()
+    return fgen, x
+
+
+def conv_dtypes(module, run):
+    dtypes = []
+    hooks = [m.register_forward_hook(lambda m, i, o: dtypes.append(o.dtype))
+             for m in module.modules() if isinstance(m, Conv2dWeightNorm)]
+    try:
+        run()
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return dtypes
+
+
+def test_dequant_convs_run_under_model_amp_dtype():
+    fgen, x = build('bfloat16')
+    dequant = fgen.dequant_flow
+    with torch.no_grad():
+        encoder_dtypes = conv_dtypes(dequant.encoder, lambda: fgen.dequantize(x, nsamples=2))
+        macow_dtypes = conv_dtypes(dequant.macow, lambda: fgen.dequantize(x, nsamples=2))
+        u, log_posteriors = fgen.dequantize(x, nsamples=2)
+    assert encoder_dtypes and all(dtype == torch.bfloat16 for dtype in encoder_dtypes)
+    assert macow_dtypes and all(dtype == torch.bfloat16 for dtype in macow_dtypes)
+    # the outputs are returned in fp32
+    assert u.dtype == torch.float32 and log_posteriors.dtype == torch.float32
+
+
+def test_dequant_convs_stay_fp32_without_amp():
+    fgen, x = build(None)
+    with torch.no_grad():
+        dtypes = conv_dtypes(fgen.dequant_flow, lambda: fgen.dequantize(x, nsamples=2))
+    assert dtypes and all(dtype == torch.float32 for dtype in dtypes)
+
+
+def test_caller_autocast_is_kept_without_amp_dtype():
+    fgen, x = build(None)
+    with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16):
+        dtypes = conv_dtypes(fgen.dequant_flow, lambda: fgen.dequantize(x, nsamples=2))
+    assert dtypes and all(dtype == torch.bfloat16 for dtype in dtypes)